@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+import time
+import logging
+import argparse
+from encode import InputDecoder, open_input, available_cores
+
+logging.getLogger().setLevel(logging.INFO)  # hide the progress logs of InputDecoder
+
+
+def bench(in_vids, threads, thread_type, limit):
+    """
+    Decode the video of inputs continuously like Transcoder does
+    :param limit: stop after this many seconds of media (0 means decode everything)
+    :return: (decoded frames, wall time, time spent in the decoder)
+    """
+    decoder = InputDecoder({'video'}, threads, thread_type)
+    with open_input(in_vids[0]) as template:
+        decoder.init_with_template(template)
+    frames = 0
+    start = time.perf_counter()
+    for in_vid in in_vids:
+        for s, packet, decoded in decoder.demux(in_vid):
+            frames += len(decoded)
+            if limit and decoder.stats['video']['media_time'] >= limit:
+                break
+        else:
+            continue
+        break
+    frames += len(decoder.flush())
+    elapsed = time.perf_counter() - start
+    decoder.close()
+    return frames, elapsed, decoder.stats['video']['decode_time']
+
+
+parser = argparse.ArgumentParser(description="benchmark decoding fps of the Transcoder decoder with thread numbers")
+parser.add_argument('src', nargs='+', help="input videos, decoded one after another by one decoder")
+parser.add_argument('--threads', default=None, metavar='N,N,...',
+                    help="thread numbers to test (default is 1,2,4,... up to the cores available)")
+parser.add_argument('--thread_type', default='auto,frame,slice', metavar='TYPE,...',
+                    help="threading methods to test (default is auto,frame,slice)")
+parser.add_argument('--limit', type=float, default=60, metavar='SEC',
+                    help="decode only the first SEC seconds of media, 0 means all (default is 60s)")
+cli_args = parser.parse_args()
+
+if cli_args.threads is None:
+    thread_numbers = [1]
+    while thread_numbers[-1] * 2 <= available_cores():
+        thread_numbers.append(thread_numbers[-1] * 2)
+else:
+    thread_numbers = [int(n) for n in cli_args.threads.split(',')]
+
+print(f"{'type':>6} {'threads':>7} {'frames':>7} {'time':>8} {'fps':>8} {'decode fps':>10} {'speedup':>7}")
+for thread_type in cli_args.thread_type.upper().split(','):
+    base_fps = None
+    for n in thread_numbers:
+        frames, elapsed, decode_time = bench(cli_args.src, n, thread_type, cli_args.limit)
+        fps = frames / elapsed
+        base_fps = base_fps or fps
+        print(f"{thread_type:>6} {n:>7} {frames:>7} {elapsed:>7.2f}s {fps:>8.1f} "
+              f"{frames / decode_time if decode_time else 0.:>10.1f} {fps / base_fps:>6.2f}x", flush=True)
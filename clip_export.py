@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+import av
+import os
+import re
+import glob
+import json
+import logging
+import argparse
+from fractions import Fraction
+
+logging.basicConfig(format='%(asctime)s [%(levelname).1s] %(message)s', level=logging.INFO)
+logging.getLogger('libav').setLevel(logging.ERROR)
+
+
+def keyframes_around(container, t):
+    """
+    :param t: time in seconds (Fraction)
+    :return: time of the last video keyframe at or before `t` and the first one after it (None if not exist).
+             Only one GOP around `t` is read, the keyframe index of the container is used for seeking.
+    """
+    v = container.streams.video[0]
+    container.seek(max(0, int(t / v.time_base)), stream=v)  # backward to a keyframe
+    before = after = None
+    for packet in container.demux(v):
+        if packet.pts is None or not packet.is_keyframe:
+            continue
+        pt = packet.pts * v.time_base
+        if pt <= t:
+            before = pt
+        else:
+            after = pt
+            break
+    return before, after
+
+
+def annexb_to_avcc(data, length_size=4):
+    """
+    Convert H.264 NAL units with start codes (encoder output) to length prefixed ones (MP4/FLV sample format)
+    """
+    nals = [n.rstrip(b'\x00') for n in data.split(b'\x00\x00\x01')]  # also the zero byte of 4-byte start codes
+    nals = [n for n in nals if n]
+    return b''.join(len(n).to_bytes(length_size, 'big') + n for n in nals)
+
+
+def encode_head(container, keyframe, start, end, crf=18):
+    """
+    Re-encode the video between `start` and the next keyframe `end` (decoding from the previous `keyframe`), so a
+    clip can start exactly at `start`. The new parameter sets use other ids (repeated in band), so the following
+    packets can still be copied with the original parameter sets in the track header.
+    :return: list of packets in the time base of the source video stream
+    """
+    v = container.streams.video[0]
+    decoder = v.codec_context.codec.create()
+    decoder.extradata = v.codec_context.extradata
+    encoder = av.CodecContext.create('libx264', 'w')
+    encoder.width = v.codec_context.width
+    encoder.height = v.codec_context.height
+    encoder.pix_fmt = v.codec_context.pix_fmt or 'yuv420p'
+    encoder.time_base = v.time_base
+    encoder.options = {'crf': str(crf), 'preset': 'fast', 'bf': '0', 'x264-params': 'sps-id=1:repeat-headers=1'}
+    frames = []
+    container.seek(int(keyframe / v.time_base), stream=v)
+    for packet in container.demux(v):
+        if packet.dts is None:
+            continue
+        if packet.is_keyframe and packet.pts * v.time_base >= end:
+            break
+        frames += decoder.decode(packet)
+    flush = av.Packet()
+    flush.time_base = v.time_base
+    frames += decoder.decode(flush)
+    packets = []
+    for frame in frames:
+        if start <= frame.pts * v.time_base < end:
+            frame.pict_type = 0  # let the encoder decide, the first one will be IDR
+            packets += encoder.encode(frame)
+    packets += encoder.encode(None)
+
+    extradata = v.codec_context.extradata or b''
+    length_size = (extradata[4] & 3) + 1 if extradata[:1] == b'\x01' else None  # None: stream uses start codes
+    head = []
+    for p in packets:
+        new_packet = av.Packet(bytes(p) if length_size is None else annexb_to_avcc(bytes(p), length_size))
+        new_packet.pts = p.pts
+        new_packet.dts = p.pts  # no B-frames, the delay of the source is applied by the caller
+        new_packet.time_base = v.time_base
+        new_packet.is_keyframe = p.is_keyframe
+        head.append(new_packet)
+    return head
+
+
+def clip_start(container, start, exact=False):
+    """
+    :param exact: start at `start` by re-encoding the head GOP, otherwise start at the nearest keyframe
+    :return: (start of the clip, keyframe where stream copy starts, keyframe to decode the head from), all None if
+             there is no keyframe
+    """
+    before, after = keyframes_around(container, start)
+    if before is None:
+        before = after
+    if exact and before != start and after is not None:
+        return start, after, before
+    if after is not None and after - start < start - before:
+        before = after
+    return before, before, before
+
+
+def export_clip(in_name, out_name, start, end, exact=False):
+    """
+    Cut [start, end) (seconds) of the input to a new file by stream copy.
+    :param exact: start at `start` by re-encoding the head GOP, otherwise start at the nearest keyframe
+    :return: (start, end) of the clip in the input
+    """
+    with av.open(in_name) as container:
+        v = container.streams.video[0]
+        a = container.streams.audio[0] if container.streams.audio else None
+        start, copy_from, keyframe = clip_start(container, start, exact)
+        if copy_from is None or copy_from >= end:
+            raise ValueError("no keyframe in the clip range")
+        head = [] if copy_from == start else encode_head(container, keyframe, start, copy_from)
+
+        output = av.open(out_name, mode='w')
+        streams = {v.index: output.add_stream(template=v)}
+        if a is not None:
+            streams[a.index] = output.add_stream(template=a)
+        offsets = {s.index: int(start / s.time_base) for s in container.streams if s.index in streams}
+        finished = set()
+        delay = None
+        container.seek(max(0, int((min(start, copy_from) - 1) / v.time_base)), stream=v)
+        for packet in container.demux(*[s for s in container.streams if s.index in streams]):
+            if packet.dts is None or packet.pts is None or packet.stream.index in finished:
+                continue
+            pt = packet.pts * packet.time_base
+            if packet.stream.index == v.index:
+                if pt < copy_from or (delay is None and not packet.is_keyframe):
+                    continue
+                if delay is None:  # the first copied keyframe, mux the re-encoded head before it
+                    delay = packet.pts - packet.dts
+                    for p in head:
+                        p.dts -= delay
+                        p.pts -= offsets[v.index]
+                        p.dts -= offsets[v.index]
+                        p.stream = streams[v.index]
+                        output.mux(p)
+            elif pt < start:
+                continue
+            # by dts for video: frames after `end` in decoding order may still be referenced by earlier frames
+            if (packet.dts if packet.stream.index == v.index else packet.pts) * packet.time_base >= end:
+                finished.add(packet.stream.index)
+                if len(finished) == len(streams):
+                    break
+                continue
+            packet.pts -= offsets[packet.stream.index]
+            packet.dts -= offsets[packet.stream.index]
+            packet.stream = streams[packet.stream.index]
+            output.mux(packet)
+        output.close()
+    return start, end
+
+
+def clip_ranges(highlight, duration, before, max_length):
+    """
+    A highlight lasts until the next one (at most `max_length` seconds), starting `before` seconds earlier
+    """
+    times = [h['time'] for h in highlight] + [duration]
+    for i, h in enumerate(highlight):
+        start = max(0, h['time'] - before)
+        end = min(times[i + 1], h['time'] + max_length, duration)
+        if start < end:
+            yield h, Fraction(start), Fraction(end)
+        else:
+            logging.warning("highlight at %ss is out of the video, skipped", h['time'])
+
+
+def clip_name(i, h):
+    text = re.sub(r'[\\/:*?"<>|\s]+', ' ', h['text']).strip()[:60]
+    return f"{i:02d} {int(h['time']) // 60:02d}-{int(h['time']) % 60:02d} {text}.mp4"
+
+
+parser = argparse.ArgumentParser(description="export highlight clips in 'play' files by stream copy [v230401]")
+parser.add_argument('path', help="recording directory/directories (glob pattern)")
+parser.add_argument('-i', '--input', default='transcoded/origin.mp4',
+                    help="video in the recording directory to cut from (default is 'transcoded/origin.mp4')")
+parser.add_argument('-o', '--output', default='clips', help="output directory in the recording (default is 'clips')")
+parser.add_argument('--before', type=float, default=0, metavar='SEC',
+                    help="start clips earlier than the highlight time (default is 0)")
+parser.add_argument('--max_length', type=float, default=600, metavar='SEC',
+                    help="clips end at the next highlight, but not longer than this (default is 600s)")
+parser.add_argument('--exact', action='store_true',
+                    help="start clips exactly at the time by re-encoding the first GOP (default snaps to keyframes)")
+parser.add_argument('-f', '--force', action='store_true', help="overwrite existing clips")
+cli_args = parser.parse_args()
+
+for rec_dir in glob.glob(cli_args.path):
+    play_name = os.path.join(rec_dir, 'play')
+    in_name = os.path.join(rec_dir, cli_args.input)
+    try:
+        with open(play_name, encoding='utf8') as play_f:
+            highlight = json.load(play_f).get('highlight')
+    except (OSError, ValueError):
+        logging.error("'%s' is not a valid play file, skipped", play_name)
+        continue
+    if not highlight:
+        logging.info("no highlight in %s, skipped", rec_dir)
+        continue
+    if not os.path.isfile(in_name):
+        logging.error("'%s' not found, skipped", in_name)
+        continue
+    with av.open(in_name) as c:
+        # unknown for some FLVs, then the last clip is limited by max_length only
+        duration = Fraction(c.duration, av.time_base) if c.duration else Fraction(10 ** 9)
+    out_dir = os.path.join(rec_dir, cli_args.output)
+    os.makedirs(out_dir, exist_ok=True)
+    index_name = os.path.join(out_dir, 'clips.json')
+    try:
+        with open(index_name, encoding='utf8') as f:
+            old_index = {c['file']: c for c in json.load(f)}
+    except (OSError, ValueError):
+        old_index = {}
+    index = []
+    for i, (h, start, end) in enumerate(clip_ranges(highlight, duration, cli_args.before, cli_args.max_length), 1):
+        out_name = os.path.join(out_dir, clip_name(i, h))
+        if os.path.exists(out_name) and not cli_args.force:
+            logging.warning("not overwriting '%s'", out_name)
+            # keep the clip in the index, made before the index existed if not in it (the same start snapping)
+            if (entry := old_index.get(os.path.basename(out_name))) is None:
+                with av.open(in_name) as c:
+                    start = clip_start(c, start, cli_args.exact)[0]
+                if start is not None:
+                    entry = {'time': h['time'], 'text': h['text'], 'file': os.path.basename(out_name),
+                             'start': float(start), 'end': float(end)}
+            if entry is not None:
+                index.append(entry)
+            continue
+        try:
+            start, end = export_clip(in_name, out_name, start, end, cli_args.exact)
+        except (ValueError, av.AVError) as e:
+            logging.error("failed to export '%s': %s", out_name, e)
+            continue
+        logging.info("exported '%s' (%.3fs - %.3fs)", out_name, start, end)
+        index.append({'time': h['time'], 'text': h['text'], 'file': os.path.basename(out_name),
+                      'start': float(start), 'end': float(end)})
+    with open(index_name, 'w', encoding='utf8') as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
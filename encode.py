@@ -5,12 +5,20 @@ import os
 import logging
 import time
 from fractions import Fraction
-from queue import Queue, PriorityQueue, Empty
-import warnings
-import random
+from queue import Queue, Empty
+from collections import deque
+from itertools import chain
 import threading
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 import argparse
+import json
+import shutil
+import multiprocessing
+from multiprocessing import shared_memory
+import traceback
+import numpy as np
+from av.video.reformatter import VideoReformatter
 
 logging.basicConfig(format='%(asctime)s [%(levelname).1s] [%(name)s] %(message)s', level=logging.DEBUG)
 logging.getLogger('libav').setLevel(logging.INFO)
@@ -34,74 +42,427 @@ def copy_packet(packet):
     return new_packet
 
 
-class AsyncStream(ABC):
+def available_cores():
     """
-    Designed for encode in a separate thread for very slow encoders
+    :return: number of cores this process may run on (respect CPU affinity if supported)
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on Windows/macOS
+        return os.cpu_count() or 1
+
+
+def plan_threads(modes, jobs=1, cores=None):
+    """
+    Share the cores among the decoder and the encoders of this job, assuming `jobs` similar jobs run concurrently
+    :param modes: output modes of this job
+    :return: dict of core budget of the job ('cores') and thread numbers of 'decode', 'hq' (x264 threads)
+             and 'compact' (SVT-AV1 logical processors)
+    """
+    cores = available_cores() if cores is None else cores
+    budget = max(1, cores // max(1, jobs))
+    weights = {'hq': 2, 'compact': 3}  # relative encoding cost, SVT-AV1 preset 5 is slower than x264 (per pixel)
+    encoders = [m for m in modes if m in weights]
+    plan = {'cores': budget, 'decode': 1}
+    if encoders:
+        plan['decode'] = max(1, budget // 8)  # H.264 decoding is about an order of magnitude faster than encoding
+        rest = max(1, budget - plan['decode'])
+        total_weight = sum(weights[m] for m in encoders)
+        for m in encoders:
+            plan[m] = max(1, round(rest * weights[m] / total_weight))
+        if 'hq' in plan:  # more x264 frame threads give little speedup but worse quality
+            plan['hq'] = min(plan['hq'], 16)
+    return plan
+
+
+class GrowingFile:
+    """
+    Read-only file object for a video which may be still being written. Reaching the end, it waits for new data
+    instead of returning EOF, until the file is sealed:
+    - the sentinel file exists
+    - a later video (sorted by name) appears in the same directory (the recorder moved on to the next part)
+    - the aria2 control file disappears (if it existed, aria2 removes it when the download is complete)
+    - no new data in `timeout` seconds
+    """
+
+    def __init__(self, name, timeout=60., sentinel=None, poll_interval=0.5):
+        self.name = name
+        self.timeout = timeout
+        self.sentinel = sentinel
+        self.poll_interval = poll_interval
+        self._file = open(name, 'rb')
+        self._aria2 = os.path.exists(name + '.aria2')
+        self._last_data = time.time()
+
+    def sealed(self):
+        if self.sentinel is not None and os.path.exists(self.sentinel):
+            return True
+        directory, base = os.path.split(os.path.abspath(self.name))
+        if any(n > base and n[-3:] in ['flv', 'mp4'] for n in os.listdir(directory)):
+            return True
+        if self._aria2 and not os.path.exists(self.name + '.aria2'):
+            return True
+        return self._last_data + self.timeout < time.time()
+
+    def read(self, size=-1):
+        while True:
+            data = self._file.read(size)
+            if data:
+                self._last_data = time.time()
+                return data
+            if self.sealed():
+                return self._file.read(size)  # the last bytes may be written just before sealed
+            time.sleep(self.poll_interval)
+
+    def close(self):
+        self._file.close()
+
+
+@contextmanager
+def open_input(in_vid, follow=None):
+    """
+    Open an input container, closed with the GrowingFile it reads from (av.open does not close a file object)
+    :param follow: keyword arguments of GrowingFile if the input may be still growing, None for a complete file
+    """
+    growing = None if follow is None else GrowingFile(in_vid, **follow)
+    try:
+        with av.open(in_vid if growing is None else growing, metadata_errors='ignore') as container:
+            yield container
+    finally:
+        if growing is not None:
+            growing.close()
+
+
+def frame_size(frame):
+    """
+    :return: memory used by the frame data (in bytes), 0 for the flushing frame `None`
+    """
+    if frame is None:
+        return 0
+    return sum(p.buffer_size for p in frame.planes)
+
+
+class FrameFanout:
+    """
+    Hand the same decoded frame to several AsyncStream consumers without duplicating it.
+    The frames held by all consumers are limited by a global memory budget (in bytes); `put` blocks the demuxer
+    (backpressure) until enough frames are released by the consumers.
+    """
+
+    def __init__(self, budget=1024 * 1024 * 1024):
+        self.budget = budget
+        self._used = 0
+        self._refs = {}  # id(frame) -> [reference count, size, callback after released]
+        self._cond = threading.Condition()
+        self._closed = False
+        self.put_blocked = 0.  # seconds the demuxer spent waiting for free memory
+
+    @property
+    def used(self):
+        return self._used
+
+    def put(self, frame, consumers, on_release=None):
+        """
+        :param on_release: called with the frame after it is released by all consumers
+        """
+        consumers = list(consumers)
+        if not consumers:
+            if on_release is not None and frame is not None:
+                on_release(frame)
+            return
+        size = frame_size(frame)
+        if size:
+            with self._cond:
+                ref = self._refs.get(id(frame))
+                if ref is None:  # only count the memory once even if a frame is put multiple times
+                    # always accept a frame when nothing is held, otherwise a small budget will block forever
+                    wait_start = time.perf_counter()
+                    while self._used and self._used + size > self.budget and not self._closed:
+                        self._cond.wait()
+                    self.put_blocked += time.perf_counter() - wait_start
+                    self._used += size
+                    ref = self._refs[id(frame)] = [0, size, on_release]
+                ref[0] += len(consumers)
+        for c in consumers:
+            c._queue.put(frame)
+
+    def release(self, frame):
+        if frame is None:
+            return
+        with self._cond:
+            ref = self._refs.get(id(frame))
+            if ref is None:
+                return
+            ref[0] -= 1
+            if ref[0] > 0:
+                return
+            del self._refs[id(frame)]
+            self._used -= ref[1]
+            self._cond.notify_all()
+        if ref[2] is not None:
+            ref[2](frame)
+
+    def close(self):
+        """
+        Stop blocking `put` (used when consumers are force stopped and will never release their frames)
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class InterleaveMuxer:
+    """
+    Mux packets from several threads into one container in dts order.
+    The stream heads are tracked separately: a packet is muxed as soon as every unfinished stream has packets
+    queued (so nothing earlier can arrive later), or when more than `max_buffer` packets are pending.
+    """
+
+    def __init__(self, container, max_buffer=4096):
+        self.container = container
+        self.max_buffer = max_buffer
+        self._buffers = None  # stream index -> deque of (time, sequence, packet), created on first push
+        self._finished = set()
+        self._attached = set()  # streams finished by their own encoding threads
+        self._pending = 0
+        self._sequence = 0  # keep the arriving order of packets with the same time
+        self._lock = threading.Lock()
+        self.done = threading.Event()  # set when all the streams are finished and muxed
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def push(self, packets):
+        if isinstance(packets, av.Packet):
+            packets = [packets]
+        with self._lock:
+            if self._buffers is None:  # all streams should have been added to the container before muxing
+                self._buffers = {s.index: deque() for s in self.container.streams}
+            for p in packets:
+                assert isinstance(p, av.Packet)
+                ts = p.dts if p.dts is not None else p.pts
+                self._buffers[p.stream.index].append((ts * p.time_base, self._sequence, p))
+                self._sequence += 1
+                self._pending += 1
+            self._drain()
+
+    def _drain(self, flush_all=False):
+        while self._pending:
+            heads = [b[0] for b in self._buffers.values() if b]
+            if not flush_all and self._pending <= self.max_buffer:
+                # low watermark: an unfinished stream without queued packets may still give earlier packets
+                if any(not b and i not in self._finished for i, b in self._buffers.items()):
+                    break
+            head = min(heads, key=lambda x: x[:2])
+            p = self._buffers[head[2].stream.index].popleft()[2]
+            self._pending -= 1
+            self.container.mux_one(p)
+
+    def attach(self, stream):
+        """
+        The stream is encoded in its own thread, which calls `finish` when the encoder is flushed
+        """
+        self._attached.add(stream.index)
+
+    def finish(self, stream):
+        """
+        Mark that no more packets will be pushed for the stream
+        """
+        with self._lock:
+            if self._buffers is None:
+                self._buffers = {s.index: deque() for s in self.container.streams}
+            self._finished.add(stream.index)
+            if len(self._finished) == len(self._buffers):
+                self._drain(True)
+                self.done.set()
+            else:
+                self._drain()
+
+    def close(self):
+        """
+        Mark the streams without encoding threads finished, everything is muxed after all attached streams finish
+        """
+        for s in self.container.streams:
+            if s.index not in self._attached:
+                self.finish(s)
+
+
+class VideoReducer:
+    """
+    Scale down and decimate the video of one output. The scaler is reused for all frames, and the scaled frames are
+    new ones, so the frames shared with other outputs are never modified. Kept frames keep their original pts.
+    """
+
+    def __init__(self, width, height, rate, max_height=0, max_fps=0):
+        """
+        :param max_height: scale down (keeping the aspect ratio) if the source is higher, 0 means no scaling
+        :param max_fps: drop frames if the source frame rate is higher, 0 means no decimation
+        """
+        self.width, self.height = width, height
+        if 0 < max_height < height:
+            self.height = max_height - max_height % 2
+            self.width = round(width * self.height / height / 2) * 2
+        self.rate = rate
+        self._step = None  # output frame interval (in seconds)
+        if max_fps > 0 and (rate is None or max_fps < rate):
+            self.rate = Fraction(max_fps).limit_denominator(1001)
+            self._step = 1 / self.rate
+        self._scale = (self.width, self.height) != (width, height)
+        self._reformatter = VideoReformatter()
+        self._next_time = None
+        self.dropped = 0
+
+    def __call__(self, frame):
+        """
+        :return: the frame for the output, or None if dropped
+        """
+        if self._step is not None and frame.pts is not None:
+            t = frame.pts * frame.time_base
+            # tolerate the timestamp jitter of the source, e.g. 16/17ms intervals of 60fps FLV
+            if self._next_time is not None and t < self._next_time - self._step / 4:
+                self.dropped += 1
+                return None
+            if self._next_time is not None and t < self._next_time + self._step:
+                self._next_time += self._step  # keep the cadence
+            else:
+                self._next_time = t + self._step  # first frame or after a gap
+        if self._scale:
+            frame = self._reformatter.reformat(frame, self.width, self.height, interpolation='BICUBIC')
+        return frame
+
+
+def drop_samples(frame, count):
+    """
+    :return: a copy of the audio frame without its first `count` samples, None if no sample is left
+    """
+    if count >= frame.samples:
+        return None
+    array = frame.to_ndarray()
+    array = array[:, count:] if frame.format.is_planar else array[:, count * len(frame.layout.channels):]
+    new_frame = av.AudioFrame.from_ndarray(np.ascontiguousarray(array), format=frame.format.name,
+                                           layout=frame.layout.name)
+    new_frame.sample_rate = frame.sample_rate
+    new_frame.time_base = frame.time_base
+    if frame.pts is not None:
+        new_frame.pts = frame.pts + round(Fraction(count, frame.sample_rate) / frame.time_base)
+    return new_frame
+
+
+class FanoutConsumer(ABC):
+    """
+    A consumer of FrameFanout running in its own thread: takes the shared frames from its queue until `None` (the
+    end), and releases them after use. Subclasses call `__init__` at the end of theirs, it starts the thread.
     """
-    stream = None
-    container = None
     _queue = None
     _alive = True
 
-    def __init__(self, stream, maxsize=300):
-        self.stream = stream
-        self.container = stream.container
+    def __init__(self, fanout=None):
+        self.fanout = FrameFanout() if fanout is None else fanout
         self._thread = threading.Thread(target=self.run)
-        self._queue = Queue(maxsize)
-        self._mux_queue = PriorityQueue()
-        self._unmuxed_video = 0
-        self._finish_flag = False
+        self._queue = Queue()  # size is limited by self.fanout
+        self.stats = {'frames': 0, 'media_time': 0., 'encode_time': 0., 'get_blocked': 0.}
         self._thread.start()
 
     def put(self, frame):
-        self._queue.put(frame)
+        self.fanout.put(frame, [self])
 
     @abstractmethod
-    def _encode(self, frame):
+    def _consume(self, frame):
+        """
+        :param frame: a shared frame (must not be modified), or None at the end
+        """
         ...
 
-    def put_mux_queue(self, packets):
-        if isinstance(packets, av.Packet):
-            packets = [packets]
-        for p in packets:
-            assert isinstance(p, av.Packet)
-            self._mux_queue.put((p.dts * p.time_base + random.random() * 0.001, p))
-            if p.stream.type == 'video':
-                self._unmuxed_video += 1
-
-    def _mux_flush(self, flush_all=False):
-        try:  # mux when there are unmuxed video frames / forced flush all
-            while self._unmuxed_video > 10 or flush_all:
-                p = self._mux_queue.get_nowait()[1]
-                self.container.mux_one(p)
-                if p.stream.type == 'video':
-                    self._unmuxed_video -= 1
-        except Empty:
-            if not flush_all:
-                warnings.warn("reach end of mux_queue without flush_all")
+    @abstractmethod
+    def _finish(self):
+        """
+        Called in the thread after the end is consumed, unless force stopped
+        """
+        ...
 
     def run(self):
-        while self._alive:  # main encoding loop
+        while self._alive:  # main loop
+            wait_start = time.perf_counter()
             frame = self._queue.get()
-            self._encode(frame)
-            self._mux_flush()  # just call it periodically
+            consume_start = time.perf_counter()
+            self.stats['get_blocked'] += consume_start - wait_start
+            if not self._alive:
+                return  # force stop, exit instantly
+            if frame is not None:
+                self.stats['frames'] += 1
+                if frame.pts is not None:
+                    self.stats['media_time'] = float(frame.pts * frame.time_base)
+            self._consume(frame)
+            self.fanout.release(frame)
+            self.stats['encode_time'] += time.perf_counter() - consume_start
             if frame is None:
                 break
         else:
             return  # force stop, exit instantly
+        self._finish()
+
+    def metrics(self):
+        return {**self.stats, 'queue': self._queue.qsize(), 'mux_buffer': 0, 'dropped': 0}
+
+    def force_stop(self):
+        self._alive = False
+        self.fanout.close()
+        self._queue.put(None)  # wake up the thread if it is waiting for frames
+        self._thread.join()
+
 
-        # getting an empty packet means reaching the end
-        while not self._finish_flag:  # wait for finish signal
-            time.sleep(0.1)
-        self._mux_flush(True)  # until mux everything
+class AsyncStream(FanoutConsumer):
+    """
+    Designed for encode in a separate thread for very slow encoders
+    """
+    stream = None
+    container = None
+
+    def __init__(self, stream, fanout=None, muxer=None, reducer=None):
+        """
+        :param reducer: VideoReducer applied to the frames before encoding
+        """
+        self.stream = stream
+        self.container = stream.container
+        self.reducer = reducer
+        self.muxer = InterleaveMuxer(self.container) if muxer is None else muxer
+        self.muxer.attach(stream)
+        self._finish_event = threading.Event()
+        super().__init__(fanout)
+
+    @abstractmethod
+    def _encode(self, frame):
+        ...
+
+    def put_mux_queue(self, packets):
+        self.muxer.push(packets)
+
+    def _consume(self, frame):
+        if frame is None or self.reducer is None:
+            self._encode(frame)
+        elif (reduced := self.reducer(frame)) is not None:
+            self._encode(reduced)
+
+    def _finish(self):
+        # getting an empty packet means reaching the end, the encoder has been flushed
+        self.muxer.finish(self.stream)
+        self._finish_event.wait()  # wait for finish signal (packets from other threads are all pushed)
+        if self._alive:
+            self.muxer.close()  # until mux everything
 
     def wait_until_finish(self):
-        self._finish_flag = True
+        self._finish_event.set()
         self._thread.join()
 
+    def metrics(self):
+        return {**super().metrics(), 'mux_buffer': self.muxer.pending,
+                'dropped': 0 if self.reducer is None else self.reducer.dropped}
+
     def force_stop(self):
         self._alive = False
-        self._thread.join()
+        self._finish_event.set()
+        super().force_stop()
 
 
 class HQVideo(AsyncStream):
@@ -138,16 +499,477 @@ class CompactVideo(AsyncStream):
         self.logger(logging.DEBUG, f"{self}: queue size {self._queue.qsize()}")
 
 
+class CompactAudio(AsyncStream):
+    """
+    Re-encode audio (libopus) and generate continuous packet timestamps from the number of samples encoded
+    """
+
+    def __init__(self, *args, frame_count, trim_priming=False, **kwargs):
+        """
+        :param trim_priming: drop the input samples covered by the encoder priming, for continuing the samples of
+                             a previous encoder (resume), whose stream already has its priming
+        """
+        self.frame_count = frame_count  # shared with the output info, saved in the checkpoint state
+        self._skip = None if trim_priming else 0  # input samples to drop, known at the first frame
+        super().__init__(*args, **kwargs)
+
+    def _priming_samples(self, frame):
+        """
+        :return: the number of input samples covered by the priming (pre-skip) of the encoder
+        """
+        cc = self.stream.codec_context
+        if not cc.is_open:
+            cc.open(strict=False)
+        pre_skip = int.from_bytes(cc.extradata[10:12], 'little')  # OpusHead
+        return round(pre_skip * frame.sample_rate / cc.sample_rate)
+
+    def _encode(self, frame):
+        if self._skip is None and frame is not None:
+            self._skip = self._priming_samples(frame)
+        if self._skip and frame is not None:
+            skip = min(self._skip, frame.samples)
+            self._skip -= skip
+            if (frame := drop_samples(frame, skip)) is None:
+                return
+        new_packet = self.stream.encode(frame)
+        for p in new_packet:
+            p.time_base = Fraction(1, self.stream.sample_rate)
+            p.pts = p.dts = self.frame_count['audio']
+            self.frame_count['audio'] += p.duration
+        self.stats['media_time'] = self.frame_count['audio'] / self.stream.sample_rate
+        self.put_mux_queue(new_packet)
+
+
+class PreviewSprites(FanoutConsumer):
+    """
+    Sample the shared decoded frames at a fixed interval, downscale and tile them into JPEG sprite sheets with an
+    index JSON (`preview.json`), which gives thumbnails and seek previews without decoding the video again.
+    Runs in its own thread as a consumer of FrameFanout, like the encoders.
+    """
+
+    def __init__(self, directory, fanout, interval=10, width=160, columns=10, rows=10, state=None,
+                 partial_dir=None):
+        """
+        :param interval: seconds between thumbnails
+        :param width: width of thumbnails, the height follows the aspect ratio of the video
+        :param state: given by `get_state`, continue the sheets and the index of the previous inputs
+        :param partial_dir: where to keep the pixels of the last, partially filled sheet, so that the next input
+                            (resume mode) keeps filling it instead of starting a new sheet
+        """
+        self.directory = directory
+        self.interval = interval
+        self.partial_dir = partial_dir
+        self.index = {'interval': interval, 'width': width, 'height': None, 'columns': columns, 'rows': rows,
+                      'sheets': [], 'thumbnails': []}
+        self.next_time = None
+        self._sheet = None
+        self._count = 0  # thumbnails in the current sheet
+        self._partial = 0  # thumbnails in the partial sheet left for the next input
+        os.makedirs(directory, exist_ok=True)
+        if state is not None:
+            with open(os.path.join(directory, 'preview.json'), encoding='utf8') as f:
+                self.index = json.load(f)
+            # drop anything written after the state was saved (e.g. interrupted before the checkpoint)
+            del self.index['sheets'][state['sheets']:]
+            del self.index['thumbnails'][state['thumbnails']:]
+            self.next_time = state['next_time']
+            if state.get('partial', 0) > 0 and partial_dir is not None:
+                self._sheet = np.load(self._partial_path(state['thumbnails']))
+                self._count = state['partial']
+        self._reformatter = VideoReformatter()
+        self._sampled = 0
+        super().__init__(fanout)
+
+    def _sample(self, frame):
+        t = frame.pts * frame.time_base
+        if self.next_time is not None and t < self.next_time:
+            return
+        self.next_time = (t // self.interval + 1) * self.interval  # keep the sampling grid
+        w, h = self.index['width'], self.index['height']
+        if h is None:
+            h = self.index['height'] = round(frame.height * w / frame.width / 2) * 2
+        columns, rows = self.index['columns'], self.index['rows']
+        if self._sheet is None:
+            self._sheet = np.zeros((rows * h, columns * w, 3), np.uint8)
+        thumbnail = self._reformatter.reformat(frame, w, h, 'rgb24', interpolation='AREA').to_ndarray()
+        y, x = divmod(self._count, columns)
+        self._sheet[y * h:(y + 1) * h, x * w:(x + 1) * w] = thumbnail
+        self.index['thumbnails'].append({'time': round(float(t), 3), 'sheet': len(self.index['sheets']),
+                                         'x': x * w, 'y': y * h})
+        self._count += 1
+        self._sampled += 1
+        if self._count == columns * rows:
+            self._write_sheet()
+
+    def _write_sheet(self):
+        if self._sheet is None:
+            return
+        used_rows = -(-self._count // self.index['columns'])
+        sheet = av.VideoFrame.from_ndarray(self._sheet[:used_rows * self.index['height']], format='rgb24')
+        encoder = av.CodecContext.create('mjpeg', 'w')
+        encoder.width, encoder.height = sheet.width, sheet.height
+        encoder.pix_fmt = 'yuvj420p'
+        encoder.time_base = Fraction(1, 1)
+        encoder.options = {'qmin': '2', 'qmax': '4'}
+        packets = encoder.encode(sheet.reformat(format='yuvj420p')) + encoder.encode(None)
+        name = f"preview.{len(self.index['sheets']):03d}.jpg"
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            for p in packets:
+                f.write(bytes(p))
+        self.index['sheets'].append(name)
+        self._sheet = None
+        self._count = 0
+
+    def _partial_path(self, thumbnails):
+        # named by the thumbnail count of the state, a later input interrupted before its checkpoint keeps it intact
+        return os.path.join(self.partial_dir, f"preview_partial.{thumbnails}.npy")
+
+    def _save_index(self):
+        path = os.path.join(self.directory, 'preview.json')
+        with open(path + '.tmp', 'w', encoding='utf8') as f:
+            json.dump(self.index, f)
+        os.replace(path + '.tmp', path)
+
+    def _consume(self, frame):
+        if frame is not None and frame.pts is not None:
+            self._sample(frame)
+
+    def _finish(self):
+        if self._sheet is not None and self.partial_dir is not None:
+            np.save(self._partial_path(len(self.index['thumbnails'])), self._sheet)
+            self._partial = self._count
+        self._write_sheet()  # the last sheet may be partially filled, rewritten if the next input continues it
+        self._save_index()
+
+    def get_state(self):
+        return {'next_time':  None if self.next_time is None else float(self.next_time),
+                'sheets':     len(self.index['sheets']) - (self._partial > 0),
+                'thumbnails': len(self.index['thumbnails']), 'partial': self._partial}
+
+    def wait_until_finish(self):
+        self._thread.join()
+
+    def metrics(self):
+        return {**super().metrics(), 'dropped': self.stats['frames'] - self._sampled}
+
+
+class InputDecoder:
+    """
+    Demux inputs one after another with continuous timestamps, and decode them by only one continuous decoder
+    for each media type. Runs in the main thread, or in a separate process wrapped by DecodeProcess.
+    """
+
+    def __init__(self, decode_types, decode_threads=0, thread_type='AUTO'):
+        """
+        :param decode_threads: threads of the video decoder, 0 means decided by FFmpeg
+        :param thread_type: 'FRAME', 'SLICE' or 'AUTO' (both), frame threading delays the output by
+                            `decode_threads` frames but scales much better for H.264
+        """
+        self.decode_types = decode_types
+        self.decode_threads = decode_threads
+        self.thread_type = thread_type
+        self.decoders = {}
+        self.dummy_packet = {}
+        self.input_info = {'time_base': {'video': None, 'audio': None}, 'pts_offset': {'video': 0, 'audio': 0}}
+        self.stats = {s: {'packets': 0, 'decode_time': 0., 'media_time': 0.} for s in ['video', 'audio']}
+        self._flushed = False
+
+    def init_with_template(self, template):
+        for s in [s for s in ['video', 'audio'] if s in self.decode_types]:
+            t_s = template.streams.get({s: 0})[0]
+            # use only one continuous decoder to avoid concatenating problems (e.g. eliminate AAC priming samples)
+            decoder = t_s.codec_context.codec.create()
+            decoder.extradata = t_s.codec_context.extradata
+            if s == 'video':  # threading changes nothing but latency, the same decoder is still used for all inputs
+                decoder.thread_type = self.thread_type
+                decoder.thread_count = self.decode_threads
+            self.decoders[s] = decoder
+            # make dummy packets (used for flush decoder to yield proper time_base)
+            packet = av.Packet()
+            packet.time_base = t_s.time_base
+            self.dummy_packet[s] = packet
+
+    def demux(self, in_vid, follow=None, trim=None):
+        """
+        :param follow: see `open_input`
+        :param trim: (start, end) in seconds of the input (None for unlimited), only demux the video from the keyframe
+                     at `start` until the keyframe at `end` and the audio in the range. The other packets are skipped
+                     without decoding (see the splice plan made by record_verify_pkg/check_segment.py)
+        :return: generator of (media type, packet, decoded frames), the timestamps follow the previous inputs
+        """
+        with open_input(in_vid, follow) as input_:
+            streams_in = {}
+            offset = {}
+            start_time = {}
+            for s in ['video', 'audio']:
+                streams_in[s] = input_.streams.get({s: 0})[0]
+                offset[s] = self.input_info['pts_offset'][s]
+                if self.input_info['time_base'][s] is None:
+                    self.input_info['time_base'][s] = streams_in[s].time_base
+                elif self.input_info['time_base'][s] != streams_in[s].time_base:
+                    raise ValueError(f"file '{in_vid}' has different time base with previous ones!")
+            pts_max = {'video': 0, 'audio': 0}
+            total_time = float(input_.duration / av.time_base) if input_.duration else 0.  # unknown if growing
+            progress_logger = logging_refresh()
+            trim_start, trim_end = (None, None) if trim is None else trim
+            video_state = 'skip' if trim_start is not None else 'keep'  # 'skip' -> 'keep' -> 'end' by keyframes
+            for i, packet in enumerate(input_.demux()):
+                if packet.dts is None:
+                    continue  # dummy packages are useless for our custom decoders
+                s = packet.stream.type
+                if trim is not None:
+                    t = packet.pts * packet.time_base
+                    if s == 'video':
+                        if packet.is_keyframe and trim_end is not None and t >= trim_end - 0.0005:
+                            video_state = 'end'
+                        elif packet.is_keyframe and video_state == 'skip' and t >= trim_start - 0.0005:
+                            video_state = 'keep'
+                        if video_state != 'keep':
+                            continue
+                    elif ((trim_start is not None and t < trim_start - 0.0005)
+                          or (trim_end is not None and t >= trim_end - 0.0005)):
+                        if video_state == 'end':
+                            break  # both streams are beyond the range
+                        continue
+                # reset packet info
+                if start_time.get(s) is None:
+                    start_time[s] = packet.pts
+                    offset[s] -= start_time[s]
+                progress_time = float(max(0, (packet.dts - start_time[s]) * packet.time_base))
+                if total_time > 0:
+                    progress_logger(logging.DEBUG, f"progress={progress_time / total_time * 100:.1f}% "
+                                                   f"time={progress_time:.1f}s/{total_time:.1f}s")
+                else:
+                    progress_logger(logging.DEBUG, f"time={progress_time:.1f}s")
+                packet.pts += offset[s]
+                packet.dts += offset[s]
+                pts_max[s] = max(pts_max[s], packet.pts + packet.duration)
+                # decode by custom decoders
+                frames = []
+                if s in self.decoders:
+                    decode_start = time.perf_counter()
+                    frames = self.decoders[s].decode(packet)
+                    self.stats[s]['decode_time'] += time.perf_counter() - decode_start
+                self.stats[s]['packets'] += 1
+                self.stats[s]['media_time'] = float(packet.pts * packet.time_base)
+                yield s, packet, frames
+        self.input_info['pts_offset'] = pts_max  # save pts info for next input
+
+    def flush(self):
+        """
+        :return: list of (media type, frame) of the remaining frames in decoders
+        """
+        self._flushed = True
+        return [(s, frame) for s, decoder in self.decoders.items() for frame in decoder.decode(self.dummy_packet[s])]
+
+    def release(self, frame):
+        pass  # frames are managed by PyAV
+
+    def close(self):
+        if not self._flushed:
+            self.flush()
+        for decoder in self.decoders.values():
+            decoder.close()
+
+
+def decode_process_main(decode_types, decode_threads, thread_type, template_name, shm_name, frame_shape, slots,
+                        commands, results, free_slots):
+    """
+    Entry of the process started by DecodeProcess
+    """
+    shm = None if shm_name is None else shared_memory.SharedMemory(shm_name)
+    input_decoder = InputDecoder(decode_types, decode_threads, thread_type)
+    unused_slot = 0
+
+    def publish(s, frame):
+        nonlocal unused_slot
+        if s == 'video':
+            data = frame.to_ndarray(format='yuv420p')
+            if data.shape != frame_shape:
+                raise ValueError(f"frame size changed ({data.shape} != {frame_shape})")
+            if unused_slot < slots:
+                slot = unused_slot
+                unused_slot += 1
+            else:
+                slot = free_slots.get()  # wait until a frame is released by the main process
+            np.ndarray(frame_shape, np.uint8, shm.buf, slot * data.size)[:] = data
+            return slot, frame.pts, frame.time_base
+        return frame.to_ndarray(), frame.format.name, frame.layout.name, frame.sample_rate, frame.pts, frame.time_base
+
+    try:
+        with av.open(template_name, metadata_errors='ignore') as template:
+            input_decoder.init_with_template(template)
+        while (command := commands.get())[0] != 'close':
+            if command[0] == 'demux':
+                input_decoder.input_info = command[2]
+                for s, packet, frames in input_decoder.demux(command[1], command[3], command[4]):
+                    results.put(('packet', s, bytes(packet), packet.pts, packet.dts, packet.duration,
+                                 packet.is_keyframe, packet.time_base, input_decoder.stats[s],
+                                 [publish(s, f) for f in frames]))
+                results.put(('end', input_decoder.input_info))
+            elif command[0] == 'flush':
+                # one message per frame, the frames of a delayed decoder (e.g. frame threading) can be more than
+                # the ring slots, which are only given back after the main process gets the frames
+                for s, frame in input_decoder.flush():
+                    results.put(('frame', s, publish(s, frame)))
+                results.put(('flushed',))
+    except BaseException:
+        results.put(('error', traceback.format_exc()))
+    finally:
+        input_decoder.close()
+        if shm is not None:
+            shm.close()
+
+
+class DecodeProcess:
+    """
+    Run InputDecoder in a separate process, so demuxing/decoding does not compete for the GIL with the encoders.
+    Decoded video frames are published in a shared memory ring buffer (converted to yuv420p) and wrapped as frames
+    without copying. A slot is given back to the decoder process after its frame is released by all encoders.
+    """
+
+    def __init__(self, decode_types, decode_threads=0, thread_type='AUTO', ring_size=1024 * 1024 * 1024):
+        self.decode_types = decode_types
+        self.decode_threads = decode_threads
+        self.thread_type = thread_type
+        self.ring_size = ring_size
+        self.input_info = {'time_base': {'video': None, 'audio': None}, 'pts_offset': {'video': 0, 'audio': 0}}
+        self.stats = {s: {'packets': 0, 'decode_time': 0., 'media_time': 0.} for s in ['video', 'audio']}
+        self._process = None
+        self._shm = None
+        self._views = []
+        self._slots = {}  # id(frame) -> slot of ring buffer
+
+    def init_with_template(self, template):
+        shm_name = frame_shape = None
+        slots = 0
+        context = multiprocessing.get_context('spawn')  # not safe to fork when encoder threads are running
+        self._commands = context.Queue()
+        self._results = context.Queue()
+        self._free_slots = context.Queue()
+        if 'video' in self.decode_types:
+            t_v = template.streams.video[0].codec_context
+            frame_shape = (t_v.height * 3 // 2, t_v.width)  # yuv420p as a 2D array
+            slot_size = frame_shape[0] * frame_shape[1]
+            slots = max(4, self.ring_size // slot_size)
+            self._shm = shared_memory.SharedMemory(create=True, size=slot_size * slots)
+            shm_name = self._shm.name
+            self._views = [np.ndarray(frame_shape, np.uint8, self._shm.buf, i * slot_size) for i in range(slots)]
+        self._process = context.Process(target=decode_process_main, daemon=True,
+                                        args=(self.decode_types, self.decode_threads, self.thread_type,
+                                              template.name, shm_name, frame_shape, slots,
+                                              self._commands, self._results, self._free_slots))
+        self._process.start()
+
+    def _receive(self):
+        while True:
+            try:
+                message = self._results.get(timeout=1)
+            except Empty:
+                if not self._process.is_alive():
+                    raise RuntimeError("decode process exited unexpectedly")
+                continue
+            if message[0] == 'error':
+                raise RuntimeError(f"error in decode process:\n{message[1]}")
+            return message
+
+    def _make_frame(self, s, info):
+        if s == 'video':
+            slot, pts, time_base = info
+            frame = av.VideoFrame.from_numpy_buffer(self._views[slot], format='yuv420p')
+            self._slots[id(frame)] = slot
+        else:
+            data, format_name, layout_name, sample_rate, pts, time_base = info
+            frame = av.AudioFrame.from_ndarray(data, format=format_name, layout=layout_name)
+            frame.sample_rate = sample_rate
+        frame.pts = pts
+        frame.time_base = time_base
+        return frame
+
+    def demux(self, in_vid, follow=None, trim=None):
+        self._commands.put(('demux', in_vid, self.input_info, follow, trim))
+        while (message := self._receive())[0] == 'packet':
+            _, s, data, pts, dts, duration, is_keyframe, time_base, self.stats[s], frames = message
+            packet = av.Packet(data)
+            packet.time_base = time_base
+            packet.pts = pts
+            packet.dts = dts
+            packet.duration = duration
+            packet.is_keyframe = is_keyframe
+            yield s, packet, [self._make_frame(s, f) for f in frames]
+        self.input_info = message[1]
+
+    def flush(self):
+        """
+        :return: iterator of (media type, frame) of the remaining frames in decoders, received one by one
+        """
+        self._commands.put(('flush',))
+        while (message := self._receive())[0] == 'frame':
+            yield message[1], self._make_frame(message[1], message[2])
+
+    def release(self, frame):
+        if (slot := self._slots.pop(id(frame), None)) is not None:
+            self._free_slots.put(slot)
+
+    def close(self):
+        if self._process is not None:
+            if self._process.is_alive():
+                self._commands.put(('close',))
+                self._process.join(10)
+                if self._process.is_alive():
+                    self._process.terminate()
+            self._process = None
+            self._free_slots.cancel_join_thread()  # the released slots are useless now
+        if self._shm is not None:
+            self._views = []
+            try:
+                self._shm.close()
+            except BufferError:  # still referenced by some frames, will be unmapped at exit
+                pass
+            self._shm.unlink()
+            self._shm = None
+
+
 class Transcoder:
-    def __init__(self, containers, infos, ignore_video_pts=False):
+    def __init__(self, containers, infos, ignore_video_pts=False, frame_budget=1024 * 1024 * 1024,
+                 decode_process=False, threads=None, decode_thread_type='AUTO', reduce=None, preview=None,
+                 segment_time=None):
+        """
+        :param threads: thread numbers given by `plan_threads`, planned for a single job if not given
+        :param decode_thread_type: threading method of the video decoder ('FRAME', 'SLICE' or 'AUTO')
+        :param reduce: {mode: {'max_height': int, 'max_fps': number}} for the re-encoded outputs, see VideoReducer
+        :param preview: keyword arguments of PreviewSprites (at least 'directory') to generate previews of the video
+        :param segment_time: duration of the output segments, hq keyframes are placed at a fixed interval of it
+        """
         assert len(containers) == len(infos)
         self.containers = containers
         self.infos = infos
-        self.decoders = {}
-        self._input_info = {'time_base': {'video': None, 'audio': None}, 'pts_offset': {'video': 0, 'audio': 0}}
-        self.dummy_packet = {}
+        self.fanout = FrameFanout(frame_budget)
+        self.threads = plan_threads([info['mode'] for info in infos]) if threads is None else threads
+        total_threads = sum(n for m, n in self.threads.items() if m != 'cores')
+        logging.info(f"thread plan: {self.threads}, {total_threads} threads on {self.threads['cores']} cores "
+                     f"({total_threads / self.threads['cores']:.0%} utilization)")
+        # decode only the media types consumed by re-encoding outputs (stream copy needs no decoding)
+        decode_types = set()
+        for info in self.infos:
+            if info['mode'] == 'hq':
+                decode_types.add('video')
+            elif info['mode'] == 'compact':
+                decode_types.update(['video', 'audio'])
+        if preview is not None:
+            decode_types.add('video')
+        if decode_process:
+            self.input = DecodeProcess(decode_types, self.threads['decode'], decode_thread_type, frame_budget)
+        else:
+            self.input = InputDecoder(decode_types, self.threads['decode'], decode_thread_type)
+        self.reduce = {} if reduce is None else reduce
+        self._preview_options = preview
+        self.segment_time = segment_time
+        self._preview_state = None  # restored by set_state
+        self.preview = None
         self.ignore_video_pts = ignore_video_pts
         self.video_frame_pts = None
+        self._audio_frame_count = {}  # initial value of info['frame_count'], restored by set_state
 
     def init_with_template(self, template):
         """
@@ -156,11 +978,10 @@ class Transcoder:
         """
         t_v = template.streams.video[0]
         t_a = template.streams.audio[0]
-        t_s = {'video': t_v, 'audio': t_a}
 
-        def copy_format_info(src, dst):
-            dst.width = src.width
-            dst.height = src.height
+        def copy_format_info(src, dst, reducer=None):
+            dst.width = src.width if reducer is None else reducer.width
+            dst.height = src.height if reducer is None else reducer.height
             dst.sample_aspect_ratio = src.sample_aspect_ratio
             dst.pix_fmt = "yuv420p"
             dst.codec_context.color_range = 1
@@ -200,13 +1021,19 @@ class Transcoder:
                     'psy-rd':      '0.7:0.1',
                     'qcomp':       '0.75',
                     'x264-params': 'rc-lookahead=120',
-                    'threads':     '3',
+                    'threads':     str(self.threads['hq']),
                     'thread_type': 'frame'
                 }
-                out_v = container.add_stream('libx264', options=v_o, rate=t_v.framerate)
-                copy_format_info(t_v, out_v)
+                reducer = self._reducer(info['mode'], t_v, t_v.framerate)
+                rate = t_v.framerate if reducer is None else reducer.rate
+                if self.segment_time and rate:
+                    # fixed GOP so every segment starts with a keyframe at the same interval
+                    gop = str(max(1, round(rate * self.segment_time)))
+                    v_o.update({'g': gop, 'keyint_min': gop, 'sc_threshold': '0'})
+                out_v = container.add_stream('libx264', options=v_o, rate=rate)
+                copy_format_info(t_v, out_v, reducer)
                 out_v.codec_context.time_base = Fraction(1, 48000)
-                info['streams']['async'] = HQVideo(out_v)
+                info['streams']['async'] = HQVideo(out_v, self.fanout, reducer=reducer)
                 info['streams']['audio'] = container.add_stream(template=t_a)
             elif info['mode'] == 'compact':
                 a_o = {
@@ -221,23 +1048,40 @@ class Transcoder:
                 v_o = {
                     'preset':        '5',
                     'crf':           '50',
-                    'svtav1-params': 'tune=0:lp=6:pin=0'
+                    'svtav1-params': f"tune=0:lp={self.threads['compact']}:pin=0"
                 }
-                out_v = container.add_stream('libsvtav1', options=v_o, rate=t_v.guessed_rate)
-                copy_format_info(t_v, out_v)
+                reducer = self._reducer(info['mode'], t_v, t_v.guessed_rate)
+                out_v = container.add_stream('libsvtav1', options=v_o,
+                                             rate=t_v.guessed_rate if reducer is None else reducer.rate)
+                copy_format_info(t_v, out_v, reducer)
                 out_v.codec_context.time_base = Fraction(1, 48000)
-                info['streams']['async'] = CompactVideo(out_v, options=v_o)
-                info['frame_count'] = {'audio': 0}
+                muxer = InterleaveMuxer(container)
+                info['streams']['async'] = CompactVideo(out_v, self.fanout, muxer, reducer=reducer, options=v_o)
+                info['frame_count'] = {'audio': self._audio_frame_count.get(info['mode'], 0)}
+                info['streams']['async_audio'] = CompactAudio(out_a, self.fanout, muxer,
+                                                              frame_count=info['frame_count'],
+                                                              trim_priming=info['frame_count']['audio'] > 0)
+        if self._preview_options is not None:
+            self.preview = PreviewSprites(fanout=self.fanout, state=self._preview_state, **self._preview_options)
 
-        for s in ['video', 'audio']:
-            # use only one continuous decoder to avoid concatenating problems (e.g. eliminate AAC priming samples)
-            decoder = t_s[s].codec_context.codec.create()
-            decoder.extradata = t_s[s].codec_context.extradata
-            self.decoders[s] = decoder
-            # make dummy packets (used for flush decoder to yield proper time_base)
-            packet = av.Packet()
-            packet.time_base = t_s[s].time_base
-            self.dummy_packet[s] = packet
+        self.input.init_with_template(template)
+
+    def _reducer(self, mode, t_v, rate):
+        """
+        :return: VideoReducer of the output mode, None if it keeps the source resolution and frame rate
+        """
+        reducer = VideoReducer(t_v.width, t_v.height, rate, **self.reduce.get(mode, {}))
+        if (reducer.width, reducer.height, reducer.rate) == (t_v.width, t_v.height, rate):
+            return None
+        logging.info(f"{mode}: {t_v.width}x{t_v.height}@{rate} -> {reducer.width}x{reducer.height}@{reducer.rate}")
+        return reducer
+
+    def _video_encoders(self):
+        encoders = [info['streams']['async'] for info in self.infos if info['mode'] in ('hq', 'compact')]
+        return encoders if self.preview is None else encoders + [self.preview]
+
+    def _audio_encoders(self):
+        return [info['streams']['async_audio'] for info in self.infos if info['mode'] == 'compact']
 
     def process_frames(self, frames, frame_type):
         processed = []
@@ -252,6 +1096,7 @@ class Transcoder:
                     else:  # if not ignore, must ensure frame pts is monotonic before sent to the encoder
                         if frame.pts <= self.video_frame_pts:
                             logging.warning("Decoder gives non monotonically increasing frame pts. Skipped")
+                            self.input.release(frame)
                             continue
                         self.video_frame_pts = frame.pts
                 # I/P/B frame should be decided by the encoder rather than the source
@@ -263,147 +1108,561 @@ class Transcoder:
             processed.append(frame)
         return processed
 
-    def append(self, in_vid):
-        with av.open(in_vid, metadata_errors='ignore') as input_:
-            if self.infos[0].get('streams', None) is None:  # should be either all None or all not None
-                self.init_with_template(input_)
-            streams_in = {}
-            offset = {}
-            start_time = {}
-            for s in ['video', 'audio']:
-                streams_in[s] = input_.streams.get({s: 0})[0]
-                offset[s] = self._input_info['pts_offset'][s]
-                if self._input_info['time_base'][s] is None:
-                    self._input_info['time_base'][s] = streams_in[s].time_base
-                elif self._input_info['time_base'][s] != streams_in[s].time_base:
-                    raise ValueError(f"file '{in_vid}' has different time base with previous ones!")
-            pts_max = {'video': 0, 'audio': 0}
-            total_time = float(input_.duration / av.time_base)
-            progress_logger = logging_refresh()
-            for i, packet in enumerate(input_.demux()):
-                if packet.dts is None:
-                    continue  # dummy packages are useless for our custom decoders
-                s = packet.stream.type
-                # reset packet info
-                if start_time.get(s) is None:
-                    start_time[s] = packet.pts
-                    offset[s] -= start_time[s]
-                progress_time = float(max(0, (packet.dts - start_time[s]) * packet.time_base))
-                progress_logger(logging.DEBUG, f"progress={progress_time / total_time * 100:.1f}% "
-                                               f"time={progress_time:.1f}s/{total_time:.1f}s")
-                packet.pts += offset[s]
-                packet.dts += offset[s]
-                pts_max[s] = max(pts_max[s], packet.pts + packet.duration)
-                # decode by custom decoders
-                frames = self.process_frames(self.decoders[s].decode(packet), s)
-                # encode & mux
-                for container, info in zip(self.containers, self.infos):
-                    # CAUTION: recheck before modifying packet/frames information, they may be reused in other mode
-                    if packet.stream.type == 'video':
-                        if info['mode'] == 'origin':
-                            if packet.dts is not None:
-                                packet.stream = info['streams']['video']
-                                container.mux(packet)
-                        elif info['mode'] in ('hq', 'compact'):
-                            for frame in frames:
-                                info['streams']['async'].put(frame)
-                    if packet.stream.type == 'audio':
-                        if info['mode'] == 'origin':
-                            if packet.dts is not None:
-                                packet.stream = info['streams']['audio']
-                                container.mux(packet)
-                        elif info['mode'] == 'hq':
-                            if packet.dts is not None:
-                                new_packet = copy_packet(packet)
-                                new_packet.stream = info['streams']['audio']
-                                info['streams']['async'].put_mux_queue(new_packet)
-                        elif info['mode'] == 'compact':
-                            for frame in frames:
-                                new_packet = info['streams']['audio'].encode(frame)
-                                for p in new_packet:
-                                    p.time_base = Fraction(1, info['streams']['audio'].sample_rate)
-                                    p.pts = p.dts = info['frame_count']['audio']
-                                    info['frame_count']['audio'] += p.duration
-                                    info['streams']['async'].put_mux_queue(new_packet)
-        self._input_info['pts_offset'] = pts_max  # save pts info for next input
+    def append(self, in_vid, follow=None, trim=None):
+        """
+        :param follow: keyword arguments of GrowingFile to keep demuxing a file which is still being written
+        :param trim: (start, end) seconds of the input to transcode, see `InputDecoder.demux`
+        """
+        if self.infos[0].get('streams', None) is None:  # should be either all None or all not None
+            with open_input(in_vid, follow) as template:
+                self.init_with_template(template)
+        for s, packet, frames in self.input.demux(in_vid, follow, trim):
+            frames = self.process_frames(frames, s)
+            if s == 'video':  # share decoded frames with all video encoders
+                for frame in frames:
+                    self.fanout.put(frame, self._video_encoders(), self.input.release)
+            elif s == 'audio':  # and audio frames with all audio encoders
+                for frame in frames:
+                    self.fanout.put(frame, self._audio_encoders(), self.input.release)
+            # encode & mux
+            for container, info in zip(self.containers, self.infos):
+                # CAUTION: recheck before modifying packet/frames information, they may be reused in other mode
+                if s == 'video':
+                    if info['mode'] == 'origin':
+                        if packet.dts is not None:
+                            packet.stream = info['streams']['video']
+                            container.mux(packet)
+                if s == 'audio':
+                    if info['mode'] == 'origin':
+                        if packet.dts is not None:
+                            packet.stream = info['streams']['audio']
+                            container.mux(packet)
+                    elif info['mode'] == 'hq':
+                        if packet.dts is not None:
+                            new_packet = copy_packet(packet)
+                            new_packet.stream = info['streams']['audio']
+                            info['streams']['async'].put_mux_queue(new_packet)
 
     def flush_close(self):
-        frames = {}
-        for s in ['video', 'audio']:
-            frames[s] = self.decoders[s].decode(self.dummy_packet[s])
-            frames[s] = self.process_frames(frames[s], s)
-            frames[s].append(None)  # to flush encoder
-            self.decoders[s].close()
+        encoders = {'video': self._video_encoders(), 'audio': self._audio_encoders()}
+        for s, frame in self.input.flush():
+            for processed in self.process_frames([frame], s):
+                self.fanout.put(processed, encoders[s], self.input.release)
+        for s in ['audio', 'video']:
+            self.fanout.put(None, encoders[s], self.input.release)  # flush encoder
         for container, info in zip(self.containers, self.infos):
-            if info['mode'] == 'compact':
-                for frame in frames['audio']:
-                    new_packet = info['streams']['audio'].encode(frame)
-                    for p in new_packet:
-                        p.time_base = Fraction(1, info['streams']['audio'].sample_rate)
-                        p.pts = p.dts = info['frame_count']['audio']
-                        info['frame_count']['audio'] += p.duration
-                    info['streams']['async'].put_mux_queue(new_packet)
-            if info['mode'] in ['hq', 'compact']:
-                for frame in frames['video']:
-                    info['streams']['async'].put(frame)
-                info['streams']['async'].wait_until_finish()
+            for key in ['async_audio', 'async']:
+                if (s := info['streams'].get(key)) is not None:
+                    s.wait_until_finish()
             container.close()
+        if self.preview is not None:
+            self.preview.wait_until_finish()
+        self.input.close()
+
+    def get_state(self):
+        """
+        :return: JSON serializable timestamp information, which continues the timeline in a new Transcoder
+        """
+        state = {
+            'time_base':       {s: None if tb is None else [tb.numerator, tb.denominator]
+                                for s, tb in self.input.input_info['time_base'].items()},
+            'pts_offset':      dict(self.input.input_info['pts_offset']),
+            'video_frame_pts': self.video_frame_pts,
+            'frame_count':     {info['mode']: info['frame_count']['audio'] for info in self.infos if 'frame_count' in info}
+        }
+        if self.preview is not None:
+            state['preview'] = self.preview.get_state()
+        return state
+
+    def set_state(self, state):
+        """
+        Restore the state given by `get_state` (must be called before the first input is appended)
+        """
+        self.input.input_info['time_base'] = {s: None if tb is None else Fraction(*tb)
+                                              for s, tb in state['time_base'].items()}
+        self.input.input_info['pts_offset'] = dict(state['pts_offset'])
+        self.video_frame_pts = state['video_frame_pts']
+        self._audio_frame_count = dict(state['frame_count'])
+        self._preview_state = state.get('preview')
+
+    def metrics(self):
+        """
+        :return: a snapshot of the counters, collected by StatsExporter
+        """
+        outputs = {}
+        for info in self.infos:
+            if (s := info.get('streams', {}).get('async')) is not None:
+                outputs[info['mode']] = s.metrics()
+            if (s := info.get('streams', {}).get('async_audio')) is not None:
+                outputs[f"{info['mode']}_audio"] = s.metrics()
+        if self.preview is not None:
+            outputs['preview'] = self.preview.metrics()
+        return {
+            'decode':       {s: {**v, 'time_per_packet': v['decode_time'] / v['packets'] if v['packets'] else 0.}
+                             for s, v in self.input.stats.items()},
+            'frame_buffer': self.fanout.used,
+            'put_blocked':  self.fanout.put_blocked,
+            'outputs':      outputs
+        }
 
     def force_close(self):
         for info in self.infos:
-            if (s := info['streams'].get('async')) is not None:
-                s.force_stop()
+            for key in ['async_audio', 'async']:
+                if (s := info.get('streams', {}).get(key)) is not None:
+                    s.force_stop()
+        if self.preview is not None:
+            self.preview.force_stop()
         for c in self.containers:
             for s in c.streams:
                 if s.codec_context.is_encoder:
                     s.encode(None)
             c.close()
-        for s in ['video', 'audio']:
-            self.decoders[s].decode(self.dummy_packet[s])
-            self.decoders[s].close()
-
-
-parser = argparse.ArgumentParser(description="encode video as H.264/AV1 and mux in mp4/webm [v230401]")
-parser.add_argument('src', help="source directory for input videos")
-parser.add_argument('dst', help="destination directory for output videos")
-parser.add_argument('-t', '--type', metavar='O/H/C',
-                    help='use letter(s) to control which file will be generated (default is all)')
-parser.add_argument('--ignore_video_pts', action='store_true',
-                    help="remove the input pts info and generate 60fps video (only affect re-encoded files H/C)")
-
-cli_args = parser.parse_args()
-in_dir = cli_args.src
-out_dir = cli_args.dst
-if cli_args.type is None:
-    out_type = 'OHC'
-else:
-    out_type = [t for t in 'OHC' if t in cli_args.type.upper()]
-ignore_video_pts = cli_args.ignore_video_pts
-
-vid_names = os.listdir(in_dir)
-vid_names.sort(reverse=False)
-out_list = [av.open(os.path.join(out_dir, {'O': 'origin.mp4', 'H': 'hq.mp4', 'C': 'compact.webm'}[t]), mode='w')
-            for t in out_type]
-out_info = [{'mode': {'O': 'origin', 'H': 'hq', 'C': 'compact'}[t]} for t in out_type]
-
-if not vid_names:
-    logging.warning(f"no output video. exiting")
-    sys.exit(1)
-
-transcoder = Transcoder(out_list, out_info, ignore_video_pts)
-
-if not vid_names:
-    logging.error(f"no valid source video. exiting")
-    sys.exit(1)
-
-try:
-    for vid_name in vid_names:
-        if vid_name[-3:] in ['flv', 'mp4']:
+        self.input.close()
+
+
+class StatsExporter(threading.Thread):
+    """
+    Periodically export Transcoder metrics as JSON lines (appended) or a Prometheus textfile (`*.prom`, replaced)
+    """
+    OUTPUT_COUNTERS = ['frames', 'encode_time', 'get_blocked', 'dropped']
+    # (metric name, type, help) of the Prometheus textfile
+    PROM_METRICS = {
+        'elapsed_seconds':                 ('gauge', "Seconds since the exporter started"),
+        'frame_buffer_bytes':              ('gauge', "Decoded frames waiting to be encoded"),
+        'demux_put_blocked_seconds_total': ('counter', "Time the demuxer waited for the frame budget"),
+        'decode_packets_total':            ('counter', "Packets demuxed"),
+        'decode_seconds_total':            ('counter', "Time spent in the decoders"),
+        'decode_seconds_per_packet':       ('gauge', "Average decoding time per packet"),
+        'demux_media_seconds':             ('gauge', "Media time of the last demuxed packet"),
+        'output_frames_total':             ('counter', "Frames taken by the output"),
+        'output_fps':                      ('gauge', "Frames per second since the last export"),
+        'output_realtime_factor':          ('gauge', "Media seconds encoded per second since the last export"),
+        'output_media_seconds':            ('gauge', "Media time of the last frame taken by the output"),
+        'output_encode_seconds_total':     ('counter', "Time spent in encoding"),
+        'output_get_blocked_seconds_total': ('counter', "Time the output waited for frames"),
+        'output_queue_frames':             ('gauge', "Frames queued for the output"),
+        'output_mux_buffer_packets':       ('gauge', "Packets waiting to be interleaved"),
+        'output_dropped_frames_total':     ('counter', "Frames dropped by the reducer or not sampled"),
+    }
+
+    def __init__(self, transcoder, path, interval=10):
+        super().__init__(daemon=True)
+        self.transcoder = transcoder
+        self.path = path
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._start_time = self._last_time = time.time()
+        self._last = {}
+        self._base = None  # final counters of the previous transcoders
+
+    def set_transcoder(self, transcoder):
+        """
+        Export the metrics of a new Transcoder (resume mode makes one per input), the counters continue from the
+        final ones of the previous Transcoder
+        """
+        if self.transcoder is not None:
+            self._base = self.metrics()
+        self.transcoder = transcoder
+
+    def metrics(self):
+        """
+        :return: metrics of the transcoder, with the counters of the previous transcoders added
+        """
+        m = self.transcoder.metrics()
+        if (base := self._base) is None:
+            return m
+        m['put_blocked'] += base['put_blocked']
+        for s, v in m['decode'].items():
+            b = base['decode'].get(s, {'packets': 0, 'decode_time': 0.})
+            v['packets'] += b['packets']
+            v['decode_time'] += b['decode_time']
+            v['time_per_packet'] = v['decode_time'] / v['packets'] if v['packets'] else 0.
+        for mode, o in m['outputs'].items():
+            if (b := base['outputs'].get(mode)) is not None:
+                for key in self.OUTPUT_COUNTERS:
+                    o[key] += b[key]
+        for mode, b in base['outputs'].items():  # keep the totals if a transcoder has fewer outputs
+            m['outputs'].setdefault(mode, {**b, 'queue': 0, 'mux_buffer': 0})
+        return m
+
+    def snapshot(self):
+        now = time.time()
+        m = self.metrics()
+        dt = max(now - self._last_time, 1e-6)
+        for mode, o in m['outputs'].items():
+            last = self._last.get(mode, {'frames': 0, 'media_time': 0.})
+            o['fps'] = (o['frames'] - last['frames']) / dt
+            o['realtime'] = (o['media_time'] - last['media_time']) / dt
+            self._last[mode] = {'frames': o['frames'], 'media_time': o['media_time']}
+        self._last_time = now
+        return {'time': now, 'elapsed': now - self._start_time, **m}
+
+    def export(self):
+        if self.transcoder is None:
+            return
+        snapshot = self.snapshot()
+        if self.path.endswith('.prom'):
+            samples = {'elapsed_seconds': [('', snapshot['elapsed'])],
+                       'frame_buffer_bytes': [('', snapshot['frame_buffer'])],
+                       'demux_put_blocked_seconds_total': [('', snapshot['put_blocked'])]}
+            for key, name in [('packets', 'decode_packets_total'), ('decode_time', 'decode_seconds_total'),
+                              ('time_per_packet', 'decode_seconds_per_packet'),
+                              ('media_time', 'demux_media_seconds')]:
+                samples[name] = [(f'{{type="{s}"}}', v[key]) for s, v in snapshot['decode'].items()]
+            for key, name in [('frames', 'frames_total'), ('fps', 'fps'), ('realtime', 'realtime_factor'),
+                              ('media_time', 'media_seconds'), ('encode_time', 'encode_seconds_total'),
+                              ('get_blocked', 'get_blocked_seconds_total'), ('queue', 'queue_frames'),
+                              ('mux_buffer', 'mux_buffer_packets'), ('dropped', 'dropped_frames_total')]:
+                samples['output_' + name] = [(f'{{output="{mode}"}}', o[key])
+                                             for mode, o in snapshot['outputs'].items()]
+            lines = []
+            for name, values in samples.items():  # samples of a metric must be grouped after its type
+                metric_type, help_text = self.PROM_METRICS[name]
+                lines += [f"# HELP encode_{name} {help_text}", f"# TYPE encode_{name} {metric_type}"]
+                lines += [f"encode_{name}{labels} {value}" for labels, value in values]
+            with open(self.path + '.tmp', 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(self.path + '.tmp', self.path)  # atomic for the textfile collector
+        else:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(snapshot) + '\n')
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.export()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.export()  # the final numbers
+
+
+OUT_NAMES = {'O': 'origin.mp4', 'H': 'hq.mp4', 'C': 'compact.webm'}
+OUT_MODES = {'O': 'origin', 'H': 'hq', 'C': 'compact'}
+SEGMENT_TYPES = 'OH'  # outputs which can be written as fragmented MP4 segments with playlists
+SEGMENT_PLAYLISTS = {'hls': 'index.m3u8', 'dash': 'manifest.mpd'}
+
+
+def output_name(directory, t, part=None, segment=None):
+    """
+    :param part: index of input for the segment files in resume mode (e.g. 'hq.003.mp4'), None for final outputs
+    :param segment: options of the segmented output (see `open_output`), which is a playlist in its own directory
+                    (e.g. 'hq/index.m3u8'), None for a single file
+    """
+    name, ext = os.path.splitext(OUT_NAMES[t])
+    if segment is not None:
+        return os.path.join(directory, name, SEGMENT_PLAYLISTS[segment['format']])
+    return os.path.join(directory, name + ext if part is None else f"{name}.{part:03d}{ext}")
+
+
+def open_output(name, segment=None):
+    """
+    :param segment: {'format': 'hls' or 'dash', 'duration': seconds} to write fragmented MP4 segments and the playlist
+                    `name` (DASH also gets HLS playlists). Segments are cut at the first keyframe after `duration`,
+                    the playlist is updated after each segment so finished segments can be published at once.
+    """
+    if segment is None:
+        return av.open(name, mode='w')
+    directory = os.path.dirname(name)
+    os.makedirs(directory, exist_ok=True)
+    if segment['format'] == 'hls':
+        options = {
+            'hls_time':               str(segment['duration']),
+            'hls_segment_type':       'fmp4',
+            'hls_playlist_type':      'event',
+            'hls_flags':              'independent_segments+temp_file',
+            'hls_fmp4_init_filename': 'init.mp4',
+            'hls_segment_filename':   os.path.join(directory, 'seg_%05d.m4s')
+        }
+    else:
+        options = {
+            # the duration is measured from the start of each segment, tolerate keyframes slightly earlier than
+            # expected (timestamp rounding, B-frame delay of the first segment)
+            'seg_duration':   str(segment['duration'] * 0.95),
+            'use_template':   '1',
+            'use_timeline':   '1',
+            'hls_playlist':   '1',
+            'init_seg_name':  'init-$RepresentationID$.m4s',
+            'media_seg_name': 'seg-$RepresentationID$-$Number%05d$.m4s'
+        }
+    return av.open(name, mode='w', format=segment['format'], options=options)
+
+
+def open_outputs(directory, types, part=None, segment=None):
+    """
+    :param segment: options of segmented outputs (see `open_output`), only for the final origin/hq outputs
+    """
+    segments = [segment if part is None and t in SEGMENT_TYPES else None for t in types]
+    names = [output_name(directory, t, part, seg) for t, seg in zip(types, segments)]
+    return (names, [open_output(n, seg) for n, seg in zip(names, segments)],
+            [{'mode': OUT_MODES[t]} for t in types])
+
+
+def concat_parts(part_names, out_name, segment=None):
+    """
+    Join the segment files of resume mode by stream copy (timestamps are already continuous)
+    :param segment: see `open_output`
+    """
+    output = open_output(out_name, segment)
+    streams = None
+    pending = {}  # the last packet of each stream, muxed when the next one gives its duration
+    durations = {}
+    for name in part_names:
+        with av.open(name) as input_:
+            if streams is None:
+                streams = [output.add_stream(template=s) for s in input_.streams]
+                for s, out_s in zip(input_.streams, streams):
+                    out_s.time_base = s.time_base  # the default of the template (1/90000) rounds the timestamps
+            for packet in input_.demux():
+                if packet.dts is None:
+                    continue
+                i = packet.stream.index
+                packet.stream = streams[i]
+                if (last := pending.get(i)) is not None:
+                    # encoder packets have no duration, the muxer would drop the last frame
+                    if not last.duration:
+                        last.duration = packet.dts - last.dts
+                    durations[i] = last.duration
+                    output.mux(last)
+                pending[i] = packet
+    for i, last in pending.items():
+        if not last.duration:
+            last.duration = durations.get(i, 0)
+        output.mux(last)
+    output.close()
+
+
+def list_inputs(in_dir, follow=None):
+    """
+    :param follow: keyword arguments of GrowingFile. If given, list new inputs after the previous ones are processed,
+                   until the sentinel exists or no new input appears in the timeout
+    :return: generator of input names, sorted
+    """
+    processed = None
+    wait_start = time.time()
+    while True:
+        names = sorted(n for n in os.listdir(in_dir) if n[-3:] in ['flv', 'mp4'])
+        names = [n for n in names if processed is None or n > processed]
+        for processed in names:
+            yield processed
+        if follow is None:
+            return
+        if names:
+            wait_start = time.time()
+        elif ((follow.get('sentinel') is not None and os.path.exists(follow['sentinel']))
+              or wait_start + follow.get('timeout', 60) < time.time()):
+            return
+        else:
+            time.sleep(follow.get('poll_interval', 0.5))
+
+
+class Checkpoint:
+    """
+    Record completed inputs and the Transcoder state after each of them for resume mode.
+    Each input is transcoded to its own segment files in `directory`, joined when all inputs are completed.
+    """
+
+    def __init__(self, directory, types):
+        self.directory = directory
+        self.path = os.path.join(directory, 'checkpoint.json')
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf8') as f:
+                self.data = json.load(f)
+            if self.data['type'] != ''.join(types):
+                raise ValueError(f"checkpoint in '{directory}' is made for type '{self.data['type']}', "
+                                 "remove it to start over")
+        else:
+            self.data = {'type': ''.join(types), 'done': []}
+
+    @property
+    def completed(self):
+        return len(self.data['done'])
+
+    def is_done(self, index, name):
+        """
+        :return: whether the input has been completed (the completed inputs must be the first ones)
+        """
+        if index >= self.completed:
+            return False
+        if self.data['done'][index]['name'] != name:
+            raise ValueError(f"inputs changed since the checkpoint in '{self.directory}', remove it to start over")
+        return True
+
+    @property
+    def state(self):
+        return self.data['done'][-1]['state'] if self.data['done'] else None
+
+    def add(self, name, state):
+        self.data['done'].append({'name': name, 'state': state})
+        with open(self.path + '.tmp', 'w', encoding='utf8') as f:
+            json.dump(self.data, f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="encode video as H.264/AV1 and mux in mp4/webm [v230401]")
+    parser.add_argument('src', help="source directory for input videos")
+    parser.add_argument('dst', help="destination directory for output videos")
+    parser.add_argument('-t', '--type', metavar='O/H/C',
+                        help='use letter(s) to control which file will be generated (default is all)')
+    parser.add_argument('--ignore_video_pts', action='store_true',
+                        help="remove the input pts info and generate 60fps video (only affect re-encoded files H/C)")
+    parser.add_argument('--jobs', type=int, default=1, metavar='N',
+                        help="number of encoding jobs running on this host at the same time, used to share the cores "
+                             "(default is 1)")
+    parser.add_argument('--cores', type=int, metavar='N',
+                        help="number of cores to use for all jobs (default is all the cores available to the process)")
+    parser.add_argument('--decode_threads', type=int, metavar='N',
+                        help="threads of the video decoder, 0 means decided by FFmpeg (default is planned by cores)")
+    parser.add_argument('--decode_thread_type', choices=['auto', 'frame', 'slice'], default='auto',
+                        help="threading method of the video decoder (default is auto, using both)")
+    parser.add_argument('--decode_process', action='store_true',
+                        help="demux and decode in a separate process, pass decoded frames by shared memory")
+    parser.add_argument('--resume', action='store_true',
+                        help="write one segment per input with a checkpoint in 'DST/.parts', "
+                             "continue from the last completed input if interrupted")
+    parser.add_argument('--part_dir', metavar='PATH',
+                        help="directory of the segments and the checkpoint of --resume (default is 'DST/.parts'), "
+                             "runs making other types of the same DST need their own")
+    parser.add_argument('--follow', action='store_true',
+                        help="transcode while the source is still being recorded: wait for new data and new files "
+                             "until the sentinel file exists or nothing changes in the timeout")
+    parser.add_argument('--follow_timeout', type=float, default=60, metavar='SEC',
+                        help="regard the source as complete if no new data in this time (default is 60s)")
+    parser.add_argument('--sentinel', default='.done', metavar='NAME',
+                        help="file in the source directory which marks the recording complete (default is '.done')")
+    parser.add_argument('--splice_plan', metavar='PATH',
+                        help="transcode the ranges of inputs in the splice plan (made by record_verify_pkg/"
+                             "check_segment.py) instead of all inputs, so overlapping parts are encoded only once")
+    parser.add_argument('--stats', metavar='PATH',
+                        help="export encoding metrics periodically as JSON lines, or as a Prometheus textfile (*.prom)")
+    parser.add_argument('--stats_interval', type=float, default=10, metavar='SEC',
+                        help="interval of exporting metrics (default is 10s)")
+    parser.add_argument('--compact_height', type=int, default=720, metavar='PIXELS',
+                        help="scale down the compact video to this height, 0 keeps the source (default is 720)")
+    parser.add_argument('--compact_fps', type=float, default=30, metavar='FPS',
+                        help="drop frames of the compact video to this frame rate, 0 keeps the source (default is 30)")
+    parser.add_argument('--hq_height', type=int, default=0, metavar='PIXELS',
+                        help="scale down the hq video to this height (default is 0, keeping the source)")
+    parser.add_argument('--hq_fps', type=float, default=0, metavar='FPS',
+                        help="drop frames of the hq video to this frame rate (default is 0, keeping the source)")
+    parser.add_argument('--preview', action='store_true',
+                        help="generate thumbnail sprite sheets and 'preview.json' in 'DST/preview' from decoded frames")
+    parser.add_argument('--preview_interval', type=float, default=10, metavar='SEC',
+                        help="seconds between preview thumbnails (default is 10s)")
+    parser.add_argument('--preview_width', type=int, default=160, metavar='PIXELS',
+                        help="width of preview thumbnails (default is 160)")
+    parser.add_argument('--segment', type=float, metavar='SEC',
+                        help="write origin/hq as fragmented MP4 segments of about SEC seconds with a playlist in "
+                             "'DST/origin' and 'DST/hq' (hq keyframes are aligned to segments)")
+    parser.add_argument('--segment_format', choices=['hls', 'dash'], default='hls',
+                        help="playlist of segmented outputs, dash also writes HLS playlists (default is hls)")
+    parser.add_argument('--frame_budget', type=int, default=1024, metavar='MiB',
+                        help="memory budget for decoded frames waiting to be encoded (default is 1024 MiB)")
+
+    cli_args = parser.parse_args()
+    in_dir = cli_args.src
+    out_dir = cli_args.dst
+    if cli_args.type is None:
+        out_type = 'OHC'
+    else:
+        out_type = [t for t in 'OHC' if t in cli_args.type.upper()]
+    ignore_video_pts = cli_args.ignore_video_pts
+
+    frame_budget = cli_args.frame_budget * 1024 * 1024
+    threads = plan_threads([OUT_MODES[t] for t in out_type], cli_args.jobs, cli_args.cores)
+    if cli_args.decode_threads is not None:
+        threads['decode'] = cli_args.decode_threads
+    decode_thread_type = cli_args.decode_thread_type.upper()
+    reduce = {'hq':      {'max_height': cli_args.hq_height, 'max_fps': cli_args.hq_fps},
+              'compact': {'max_height': cli_args.compact_height, 'max_fps': cli_args.compact_fps}}
+    segment = None
+    if cli_args.segment:
+        segment = {'format': cli_args.segment_format, 'duration': cli_args.segment}
+    preview = None
+    if cli_args.preview:
+        preview = {'directory': os.path.join(out_dir, 'preview'), 'interval': cli_args.preview_interval,
+                   'width': cli_args.preview_width}
+
+    follow = None
+    if cli_args.follow:
+        follow = {'timeout': cli_args.follow_timeout, 'sentinel': os.path.join(in_dir, cli_args.sentinel)}
+    if cli_args.splice_plan:
+        if follow is not None:
+            parser.error("--splice_plan cannot be used with --follow")
+        with open(cli_args.splice_plan, encoding='utf8') as f:
+            inputs = iter([(item['name'], (item['start'], item['end'])) for item in json.load(f)['parts']])
+    else:
+        inputs = ((name, None) for name in list_inputs(in_dir, follow))
+
+    if (first_input := next(inputs, None)) is None:
+        logging.error(f"no valid source video. exiting")
+        sys.exit(1)
+    inputs = chain([first_input], inputs)
+
+    exporter = None
+    if cli_args.stats:
+        exporter = StatsExporter(None, cli_args.stats, cli_args.stats_interval)
+        exporter.start()
+
+    if not cli_args.resume:
+        _, out_list, out_info = open_outputs(out_dir, out_type, segment=segment)
+        transcoder = Transcoder(out_list, out_info, ignore_video_pts, frame_budget, cli_args.decode_process,
+                                threads, decode_thread_type, reduce, preview, cli_args.segment)
+        if exporter is not None:
+            exporter.set_transcoder(transcoder)
+        try:
+            for vid_name, trim in inputs:
+                logging.info(f"start processing '{vid_name}'")
+                transcoder.append(os.path.join(in_dir, vid_name), follow, trim)
+        except BaseException as e:
+            logging.error(f"Encounter an error. Trying to flush and close")
+            transcoder.force_close()
+            if exporter is not None:
+                exporter.stop()
+            raise e
+        transcoder.flush_close()
+    else:
+        part_dir = cli_args.part_dir or os.path.join(out_dir, '.parts')
+        checkpoint = Checkpoint(part_dir, out_type)
+        if preview is not None:
+            preview['partial_dir'] = part_dir
+        if checkpoint.completed > 0:
+            logging.info(f"resume from checkpoint, {checkpoint.completed} input(s) completed")
+        input_count = 0
+        for i, (vid_name, trim) in enumerate(inputs):
+            input_count += 1
+            if checkpoint.is_done(i, vid_name):
+                continue
             logging.info(f"start processing '{vid_name}'")
-            transcoder.append(os.path.join(in_dir, vid_name))
-except BaseException as e:
-    logging.error(f"Encounter an error. Trying to flush and close")
-    transcoder.force_close()
-    raise e
+            part_names, out_list, out_info = open_outputs(part_dir, out_type, i)
+            transcoder = Transcoder(out_list, out_info, ignore_video_pts, frame_budget,
+                                    cli_args.decode_process, threads, decode_thread_type, reduce, preview,
+                                    cli_args.segment)
+            if checkpoint.state is not None:
+                transcoder.set_state(checkpoint.state)
+            if exporter is not None:
+                exporter.set_transcoder(transcoder)
+            try:
+                transcoder.append(os.path.join(in_dir, vid_name), follow, trim)
+            except BaseException as e:
+                logging.error(f"Encounter an error. Discard the segments of '{vid_name}'")
+                transcoder.force_close()
+                for part_name in part_names:
+                    if os.path.exists(part_name):
+                        os.remove(part_name)
+                if exporter is not None:
+                    exporter.stop()
+                raise e
+            transcoder.flush_close()
+            checkpoint.add(vid_name, transcoder.get_state())
+        logging.info("all inputs completed, joining segments")
+        for t in out_type:
+            seg = segment if t in SEGMENT_TYPES else None
+            concat_parts([output_name(part_dir, t, i) for i in range(input_count)],
+                         output_name(out_dir, t, segment=seg), seg)
+        shutil.rmtree(part_dir)
 
-transcoder.flush_close()
+    if exporter is not None:
+        exporter.stop()
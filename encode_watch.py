@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import subprocess
+
+logging.basicConfig(format='%(asctime)s [%(levelname).1s] [%(name)s] %(message)s', level=logging.INFO)
+
+OUT_NAMES = {'O': 'origin.mp4', 'H': 'hq.mp4', 'C': 'compact.webm'}
+# compact is made by its own job before the others for quick publishing (the source is decoded once more), the jobs
+# of a recording keep their resume segments and checkpoints in separate directories
+STAGES = ['C', 'OH']
+ENCODE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'encode.py')
+
+
+def source_complete(source_dir, settle_time):
+    """
+    A source directory is complete when it has videos, no download is in progress (aria2 control files)
+    and nothing is modified in the last `settle_time` seconds.
+    """
+    try:
+        names = os.listdir(source_dir)
+    except OSError:
+        return False
+    if not any(n[-3:] in ['flv', 'mp4'] for n in names):
+        return False
+    if any(n.endswith('.aria2') for n in names):
+        return False
+    latest = 0
+    for n in names:
+        try:
+            latest = max(latest, os.path.getmtime(os.path.join(source_dir, n)))
+        except OSError:  # removed since listed, e.g. an aria2 control file at the end of a download
+            return False
+    return latest + settle_time < time.time()
+
+
+def part_dir(out_dir, stage):
+    return os.path.join(out_dir, f".parts_{stage}")
+
+
+def pending_types(out_dir, stage, types):
+    """
+    :param types: output types to make, only the ones of `stage` are considered
+    :return: output types the job of the stage still has to make for a recording, empty if all are done.
+             An interrupted run is resumed with the types of its checkpoint, which must not change.
+    """
+    try:
+        with open(os.path.join(part_dir(out_dir, stage), 'checkpoint.json'), encoding='utf8') as f:
+            return json.load(f)['type']
+    except FileNotFoundError:
+        pass
+    return ''.join(t for t in types if t in stage and not os.path.exists(os.path.join(out_dir, OUT_NAMES[t])))
+
+
+class JobQueue:
+    """
+    Encoding jobs (the pending output types of one stage of a recording, made by one encode.py) with their state
+    persisted in a JSON file.
+    state: 'queued' -> 'running' -> 'done' / 'failed' (after all retries)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.jobs = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf8') as f:
+                # jobs of the old formats (one per output type or recording) are dropped, the next scan finds what
+                # is left
+                self.jobs = {k: j for k, j in json.load(f)['jobs'].items() if 'stage' in j}
+            for job in self.jobs.values():
+                if job['state'] == 'running':  # interrupted last time, resumed by the checkpoint of encode.py
+                    job['state'] = 'queued'
+
+    def save(self):
+        with open(self.path + '.tmp', 'w', encoding='utf8') as f:
+            json.dump({'jobs': self.jobs}, f, indent=1, ensure_ascii=False)
+        os.replace(self.path + '.tmp', self.path)
+
+    def add(self, rec, stage, types):
+        """
+        :param types: pending output types of the stage, see `pending_types`
+        :return: whether a job is queued. A done job is queued again for the types left by it (e.g. it resumed a
+                 checkpoint made for fewer types), but not for the same types again.
+        """
+        key = f"{rec}/{stage}"
+        job = self.jobs.get(key)
+        if job is not None and (job['state'] != 'done' or not types or types == job['types']):
+            return False
+        self.jobs[key] = {'rec': rec, 'stage': stage, 'types': types, 'priority': STAGES.index(stage),
+                          'state': 'queued' if types else 'done', 'attempts': 0, 'added': time.time()}
+        return bool(types)
+
+    def next(self):
+        """
+        :return: the queued job with the highest priority, oldest first
+        """
+        queued = [j for j in self.jobs.values() if j['state'] == 'queued']
+        return min(queued, key=lambda j: (j['priority'], j['added']), default=None)
+
+
+class Worker:
+    def __init__(self, job, root, args):
+        self.job = job
+        rec_dir = os.path.join(root, job['rec'])
+        out_dir = os.path.join(rec_dir, 'transcoded')
+        os.makedirs(out_dir, exist_ok=True)
+        command = [sys.executable, ENCODE_SCRIPT, os.path.join(rec_dir, 'source'), out_dir, '-t', job['types'],
+                   '--resume', '--part_dir', part_dir(out_dir, job['stage']), '--jobs', str(args.workers)]
+        if args.cores is not None:
+            command += ['--cores', str(args.cores)]
+        self._log = open(os.path.join(out_dir, f"encode_{job['stage']}.log"), 'a', encoding='utf8')
+        self.process = subprocess.Popen(command, stdout=self._log, stderr=subprocess.STDOUT)
+        job['state'] = 'running'
+        job['attempts'] += 1
+        job['started'] = time.time()
+
+    def poll(self):
+        if (code := self.process.poll()) is not None:
+            self._log.close()
+        return code
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        self._log.close()
+
+
+parser = argparse.ArgumentParser(description="watch a recordings root and transcode complete 'source' directories")
+parser.add_argument('root', help="recordings root, each recording directory has 'source' and 'transcoded'")
+parser.add_argument('-t', '--type', metavar='O/H/C', default='OHC',
+                    help='use letter(s) to control which file will be generated (default is all)')
+parser.add_argument('-w', '--workers', type=int, default=2, help="number of concurrent jobs (default is 2)")
+parser.add_argument('--cores', type=int, metavar='N',
+                    help="number of cores shared by all jobs (default is all the cores available)")
+parser.add_argument('--settle', type=float, default=600, metavar='SEC',
+                    help="treat 'source' as complete if not modified in this time (default is 600s)")
+parser.add_argument('--interval', type=float, default=30, metavar='SEC', help="scan interval (default is 30s)")
+parser.add_argument('--retries', type=int, default=2, help="retry a failed job at most N times (default is 2)")
+parser.add_argument('--state', metavar='PATH',
+                    help="job state file (default is '.encode_jobs.json' in root)")
+cli_args = parser.parse_args()
+
+out_types = [t for t in 'OHC' if t in cli_args.type.upper()]
+queue = JobQueue(cli_args.state or os.path.join(cli_args.root, '.encode_jobs.json'))
+workers = []
+logger = logging.getLogger('watch')
+
+try:
+    while True:
+        # find new recordings
+        for rec in sorted(os.listdir(cli_args.root)):
+            if not source_complete(os.path.join(cli_args.root, rec, 'source'), cli_args.settle):
+                continue
+            # outputs made before watching (without checkpoint in progress) are regarded as done
+            for stage in STAGES:
+                types = pending_types(os.path.join(cli_args.root, rec, 'transcoded'), stage, out_types)
+                if queue.add(rec, stage, types):
+                    logger.info(f"queued '{rec}' ({types})")
+        # collect finished jobs
+        for w in workers[:]:
+            if (code := w.poll()) is None:
+                continue
+            workers.remove(w)
+            if code == 0:
+                w.job['state'] = 'done'
+                logger.info(f"finished '{w.job['rec']}' ({w.job['types']})")
+            elif w.job['attempts'] > cli_args.retries:
+                w.job['state'] = 'failed'
+                logger.error(f"failed '{w.job['rec']}' ({w.job['types']}), exit code {code}")
+            else:
+                w.job['state'] = 'queued'
+                logger.warning(f"retry '{w.job['rec']}' ({w.job['types']}), exit code {code}")
+        # start jobs
+        while len(workers) < cli_args.workers:
+            if (job := queue.next()) is None:
+                break
+            logger.info(f"start '{job['rec']}' ({job['types']})")
+            workers.append(Worker(job, cli_args.root, cli_args))
+        queue.save()
+        time.sleep(cli_args.interval)
+except KeyboardInterrupt:
+    logger.info("stopping, running jobs will be resumed next time")
+    for w in workers:
+        w.stop()
+        w.job['state'] = 'queued'
+    queue.save()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import time
+import random
+import argparse
+from hashlib import md5
+from check_segment import ConnectPart
+
+
+def synthetic_parts(segments, parts, overlap, repeat, seed):
+    """
+    Keyframe md5 lists of one stream cut into parts, each part starts up to `overlap` segments before the end of
+    the previous one (but not before its beginning, like a recorder reconnecting). `repeat` of the keyframes are the same (e.g. a static image).
+    """
+    rng = random.Random(seed)
+    stream = [md5(str(i if rng.random() >= repeat else -1).encode()).hexdigest() for i in range(segments)]
+    cuts = sorted(rng.sample(range(1, segments), parts - 1))
+    result = []
+    prev_begin = 0
+    for begin, end in zip([0] + cuts, cuts + [segments]):
+        result.append(stream[begin - rng.randint(0, min(overlap, begin - prev_begin)):end])
+        prev_begin = begin
+    return result
+
+
+def bench(seqs, align):
+    """
+    :return: (positions of the parts, seconds) of aligning the parts one after another like ConnectPart does
+    """
+    align_func = {'index': ConnectPart._align_index, 'matcher': ConnectPart._align_matcher}[align]
+    start = 0
+    positions = [0]
+    t = time.perf_counter()
+    for i in range(1, len(seqs)):
+        start += align_func(seqs[i - 1], seqs[i], i)
+        positions.append(start)
+    return positions, time.perf_counter() - t
+
+
+parser = argparse.ArgumentParser(description="benchmark the alignment methods of ConnectPart on synthetic parts")
+parser.add_argument('--segments', default='1000,10000,50000', metavar='N,N,...',
+                    help="numbers of segments of the whole stream (default is 1000,10000,50000)")
+parser.add_argument('--parts', type=int, default=8, help="number of parts (default is 8)")
+parser.add_argument('--overlap', type=int, default=200, help="max overlapping segments (default is 200)")
+parser.add_argument('--repeat', type=float, default=0, metavar='RATIO',
+                    help="ratio of repeated keyframes (default is 0)")
+parser.add_argument('--seed', type=int, default=1)
+cli_args = parser.parse_args()
+
+print(f"{'segments':>8} {'matcher':>9} {'index':>9} {'speedup':>8} same")
+for n in [int(n) for n in cli_args.segments.split(',')]:
+    seqs = synthetic_parts(n, cli_args.parts, cli_args.overlap, cli_args.repeat, cli_args.seed)
+    results = {}
+    for align in ['matcher', 'index']:
+        try:
+            results[align] = bench(seqs, align)
+        except ValueError as e:
+            results[align] = (str(e), float('nan'))
+    (pos_m, t_m), (pos_i, t_i) = results['matcher'], results['index']
+    print(f"{n:>8} {t_m:>8.3f}s {t_i:>8.3f}s {t_m / t_i if t_i else 0.:>7.1f}x {pos_m == pos_i}", flush=True)
@@ -1,8 +1,12 @@
 import json
 from difflib import SequenceMatcher
 from collections import namedtuple
-from itertools import chain
+from collections.abc import Sequence
+from copy import copy
 import logging
+import argparse
+import numpy as np
+from hash_file import COLUMNS, segment_field, load_hash_file
 
 
 class HashCheckDifference(Exception):
@@ -65,17 +69,72 @@ class Segment(namedtuple('Segment',
         return hash(self.segment_md5)
 
 
-class Part(list):
+class Part:
+    """
+    Segments of a video stored in NumPy arrays, one per column of `hash_file.COLUMNS` (digests are raw 16 bytes).
+    Items are Segments made on access, slices are Parts sharing the arrays.
+    """
+
     def __init__(self, info):
-        super().__init__(Segment(time_base=info['time_base'], **seg) for seg in info['data'])
+        """
+        :param info: result of segment_hash.py, or a part read by `hash_file.read_hash_file` (with 'columns').
+                     Columns missing in the results of quick mode are not stored.
+        """
         self.name = info['name']
         self.time_base = VATuple(**info['time_base'])
+        if 'columns' in info:
+            self.columns = dict(info['columns'])
+        else:
+            data = info['data']
+            self.columns = {}
+            for column, dtype in COLUMNS:
+                try:
+                    values = [segment_field(seg, column) for seg in data]
+                except KeyError:
+                    continue
+                if dtype == 'V16':
+                    values = [bytes.fromhex(v) for v in values]
+                self.columns[column] = np.array(values, dtype=dtype)
+
+    @property
+    def quick(self):
+        """
+        Made by the quick mode of segment_hash.py, only keyframes are hashed (no segment digests or frame counts)
+        """
+        return 'frames.video' not in self.columns
+
+    def __len__(self):
+        return len(self.columns['keyframe_md5'])
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            view = copy(self)
+            view.columns = {k: v[item] for k, v in self.columns.items()}
+            return view
+        i = range(len(self))[item]
+        c = self.columns
+        seg = {'keyframe_md5': c['keyframe_md5'][i].tobytes().hex(), 'start_pts': int(c['start_pts'][i]),
+               'time_base': self.time_base._asdict()}
+        if 'end_pts' in c:
+            seg['end_pts'] = int(c['end_pts'][i])
+        for field in ['segment_md5', 'frames']:
+            if field + '.video' in c:
+                seg[field] = {t: c[f"{field}.{t}"][i] for t in ['video', 'audio']}
+        if 'segment_md5' in seg:
+            seg['segment_md5'] = {t: v.tobytes().hex() for t, v in seg['segment_md5'].items()}
+        if 'frames' in seg:
+            seg['frames'] = {t: int(v) for t, v in seg['frames'].items()}
+        return Segment(**seg)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
 
     def __eq__(self, other):
         if self is other:
             return True
         eq = isinstance(other, Part) and self.name == other.name and self.time_base == other.time_base
-        return eq and super().__eq__(self, other)
+        return eq and self.columns.keys() == other.columns.keys() and all(
+            np.array_equal(v, other.columns[k]) for k, v in self.columns.items())
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -104,6 +163,12 @@ class SubPart:
     def __getitem__(self, item):
         return self.part[self.start:self.end][item]
 
+    def __iter__(self):
+        return iter(self.part[self.start:self.end])
+
+    def column(self, name):
+        return self.part.columns[name][self.start:self.end]
+
     def __repr__(self):
         data = {'name':       self.name,
                 'time_range': (getattr(self[0], 'start_str', 'unknown'), getattr(self[-1], 'end_str', 'unknown')),
@@ -115,41 +180,105 @@ class SubPart:
         return eq and self.start == other.start and self.end == other.end
 
 
+class ConnectedSegments(Sequence):
+    """
+    Segments of the selected SubParts of ConnectPart one after another, with an empty Segment after each group of
+    connected SubParts. Segments are made on access like Part items, only the SubPart lengths are stored.
+    """
+
+    def __init__(self, subparts):
+        self._subparts = []  # None for the empty Segment
+        for conn_part in subparts:
+            self._subparts += conn_part + [None]
+        self._ends = np.cumsum([1 if sp is None else len(sp) for sp in self._subparts], dtype=np.int64)
+
+    def __len__(self):
+        return int(self._ends[-1]) if len(self._ends) else 0
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(len(self))[item]]
+        i = range(len(self))[item]
+        k = int(np.searchsorted(self._ends, i, side='right'))
+        if (sp := self._subparts[k]) is None:
+            return Segment()
+        return sp[i - int(self._ends[k - 1] if k > 0 else 0)]
+
+    def __iter__(self):
+        for sp in self._subparts:
+            if sp is None:
+                yield Segment()
+            else:
+                yield from sp
+
+
 class ConnectPart:
-    def __init__(self, all_parts, name=None, key=None):
+    def __init__(self, all_parts, name=None, key=None, align='index'):
+        """
+        :param key: function to get the sequence of a part for aligning (default is the keyframe md5 list)
+        :param align: 'index' finds the overlap by looking up the first keyframe of a part in a digest index of the
+                      previous one, 'matcher' uses difflib.SequenceMatcher (slower, quadratic in the worst case).
+                      They give the same result when the overlap is the longest run of keyframes found in both
+                      parts, which is the case for parts of one stream.
+        """
         self.time_base = self._get_timebase(all_parts)
         self.name = name
         if key is None:
-            key = lambda x: [seg_.keyframe_md5 for seg_ in x]
+            key = lambda x: x.columns['keyframe_md5'].tolist()
+        align_func = {'index': self._align_index, 'matcher': self._align_matcher}[align]
         self._all_segments = []
         self._all_parts = all_parts
         start = 0
-        matcher = SequenceMatcher(autojunk=False)
         seq2 = key(all_parts[0])
         for seg_i, seg in enumerate(all_parts[0]):
             self._insert({'part': 0, 'seg': seg_i}, seg_i)
         for i in range(1, len(all_parts)):
             seq1, seq2 = seq2, key(all_parts[i])
-            matcher.set_seqs(seq1, seq2)
-            blocks = matcher.get_matching_blocks()
-            block = blocks[0]
-            if len(blocks) == 2:
-                if not (block.b == 0 and (block.a + block.size == len(seq1) or block.size == len(seq2))):
-                    raise ValueError(f"unable to connect part {i} with {i + 1}")
-                start += block.a
-            elif len(blocks) == 1:
-                start += block.a
-            else:
-                raise ValueError(f"multiple matching blocks in part {i} and {i + 1}")
+            start += align_func(seq1, seq2, i)
             for seg_i in range(len(seq2)):
                 self._insert({'part': i, 'seg': seg_i}, seg_i + start)
         # self.all_subparts = self._make_subparts()
         self.subparts = []
         self._make_subparts()
-        self.segments = []
-        for conn_part in self.subparts:
-            self.segments += chain.from_iterable(conn_part)
-            self.segments.append(Segment())
+        self.segments = ConnectedSegments(self.subparts)
+        self._make_index()
+
+    @staticmethod
+    def _align_matcher(seq1, seq2, i):
+        """
+        :return: position of `seq2` (part i) in `seq1` (the previous part), len(seq1) if not overlapping
+        """
+        blocks = SequenceMatcher(None, seq1, seq2, autojunk=False).get_matching_blocks()
+        block = blocks[0]
+        if len(blocks) == 2:
+            if not (block.b == 0 and (block.a + block.size == len(seq1) or block.size == len(seq2))):
+                raise ValueError(f"unable to connect part {i} with {i + 1}")
+        elif len(blocks) > 2:
+            raise ValueError(f"multiple matching blocks in part {i} and {i + 1}")
+        return block.a
+
+    @staticmethod
+    def _align_index(seq1, seq2, i):
+        """
+        `_align_matcher` by a digest -> positions index of `seq1`: the head of `seq2` is looked up as the anchor,
+        and the overlap is extended from it linearly. It must reach the end of `seq1` or `seq2`, the longest
+        one is used if the anchor is found more than once.
+        """
+        index = {}
+        for pos, item in enumerate(seq1):
+            index.setdefault(item, []).append(pos)
+        best_a = best_size = None
+        for a in index.get(seq2[0], []) if seq2 else []:
+            size = 0
+            while a + size < len(seq1) and size < len(seq2) and seq1[a + size] == seq2[size]:
+                size += 1
+            if (a + size == len(seq1) or size == len(seq2)) and (best_size is None or size > best_size):
+                best_a, best_size = a, size
+        if best_a is not None:
+            return best_a
+        if any(item in index for item in seq2):
+            raise ValueError(f"unable to connect part {i} with {i + 1}")
+        return len(seq1)
 
     @staticmethod
     def _get_timebase(parts):
@@ -201,50 +330,137 @@ class ConnectPart:
 
     @staticmethod
     def _select_best(subparts):
+        """
+        The best SubPart has the most frames (video first, then audio) in every segment, the first one is used if
+        several are the best. It may be corrupted if segments with the most frames have different digests.
+        """
         if len(subparts) == 1:
             return subparts[0]
-        best_idx = set(range(len(subparts)))  # Assume all is good at first
+        if subparts[0].part.quick:
+            logging.warning("Cannot compare SubParts of quick fingerprints. Use the first one, which may be truncated.")
+            return subparts[0]
+        video = np.stack([sp.column('frames.video') for sp in subparts])  # (subpart, segment)
+        audio = np.stack([sp.column('frames.audio') for sp in subparts])
+        best = video == video.max(axis=0)
+        best &= audio == np.where(best, audio, -1).max(axis=0)
+        first = best.argmax(axis=0)  # the first best subpart of each segment
+        seg_range = np.arange(best.shape[1])
         corrupted = False
-        for sp in zip(*subparts):
-            sp_enum = list(enumerate(sp))
-            sp_enum.sort(key=lambda x: (x[1], -x[0]), reverse=True)
-            best_idx_i = set()
-            for sp_i in sp_enum:
-                if sp_i[1] < sp_enum[0][1]:
-                    break
-                best_idx_i.add(sp_i[0])
-                if sp_i[1] != sp_enum[0][1]:
-                    corrupted = True
-            best_idx &= best_idx_i
+        for t in ['video', 'audio']:
+            digests = np.stack([sp.column('segment_md5.' + t) for sp in subparts])
+            corrupted |= bool((best & (digests != digests[first, seg_range])).any())
         if corrupted:
             logging.warning("Selected SubPart may be corrupted")
+        best_idx = np.flatnonzero(best.all(axis=1))
         if len(best_idx) > 0:
-            return subparts[min(best_idx)]
+            return subparts[best_idx[0]]
         else:
             logging.warning("Cannot detect best SubPart. Use the first one as fallback.")
             return subparts[0]
 
+    def _make_index(self):
+        """
+        Sorted start/end times of the selected segments in the playback timeline (the ranges of `splice_plan`
+        played one after another), with their Part and segment index. A segment lasts until the next keyframe in
+        its file, or until its 'end_pts' at the end of the file.
+        """
+        part_ids = {id(p): i for i, p in enumerate(self._all_parts)}
+        starts, ends, parts, segs, gaps = [], [], [], [], []
+        t = 0.
+        for conn_i, conn_part in enumerate(self.subparts):
+            if conn_i > 0:
+                gaps.append(t)
+            for sp in conn_part:
+                begin = sp.start or 0
+                end = len(sp.part) if sp.end is None else sp.end
+                c = sp.part.columns
+                pts = c['start_pts'][begin:end + 1]
+                if end == len(sp.part):
+                    pts = np.append(pts, max(c['end_pts'][end - 1], pts[-1]) if 'end_pts' in c else pts[-1])
+                times = (pts - pts[0]) * self.time_base.video + t
+                starts.append(times[:-1])
+                ends.append(times[1:])
+                parts.append(np.full(end - begin, part_ids[id(sp.part)]))
+                segs.append(np.arange(begin, end))
+                t = times[-1]
+        self._index_starts = np.concatenate(starts) if starts else np.zeros(0)
+        self._index_ends = np.concatenate(ends) if ends else np.zeros(0)
+        self._index_parts = np.concatenate(parts) if parts else np.zeros(0, dtype=int)
+        self._index_segs = np.concatenate(segs) if segs else np.zeros(0, dtype=int)
+        self._index_gaps = np.array(gaps)
+        self.duration = t
+
+    def _index_item(self, i):
+        part = self._all_parts[self._index_parts[i]]
+        return part, int(self._index_segs[i]), float(self._index_starts[i]), float(self._index_ends[i])
+
+    def segment_at(self, t):
+        """
+        :param t: seconds in the playback timeline
+        :return: (Part, segment index, seconds in the Part) of the segment playing at `t`, None if out of range
+        """
+        i = int(np.searchsorted(self._index_starts, t, side='right')) - 1
+        if i < 0 or t >= self._index_ends[i]:
+            return None
+        part, seg_i, start, end = self._index_item(i)
+        return part, seg_i, float(part.columns['start_pts'][seg_i] * self.time_base.video) + t - start
+
+    def segments_between(self, t0, t1):
+        """
+        :return: list of (Part, segment index, start, end) of the segments overlapping [t0, t1) in the playback
+                 timeline
+        """
+        i0 = np.searchsorted(self._index_ends, t0, side='right')
+        i1 = np.searchsorted(self._index_starts, t1, side='left')
+        return [self._index_item(i) for i in range(i0, i1)]
+
+    def gaps(self, t0=0, t1=float('inf')):
+        """
+        :return: list of times in [t0, t1] of the playback timeline where the parts are not continuous (the content
+                 in between was not recorded)
+        """
+        i0 = np.searchsorted(self._index_gaps, t0, side='left')
+        i1 = np.searchsorted(self._index_gaps, t1, side='right')
+        return self._index_gaps[i0:i1].tolist()
+
+    def splice_plan(self):
+        """
+        Ranges of the source files to play (or encode) one after another without overlapping segments.
+        A range starts at a keyframe and ends before the keyframe of the next segment in the same file.
+        :return: list of {'name': file name, 'start': seconds or None (from the beginning),
+                 'end': seconds or None (to the end)}, in the timeline of each file
+        """
+        if quick := [p.name for p in self._all_parts if p.quick]:
+            raise ValueError(f"quick fingerprints of {', '.join(quick)} cannot choose between the overlapping "
+                             "segments of parts, hash them without --quick to make a splice plan")
+        plan = []
+        for conn_part in self.subparts:
+            for sp in conn_part:
+                start = sp.start or 0
+                end = len(sp.part) if sp.end is None else sp.end
+                item = {'name':  sp.name,
+                        'start': round(sp.part[start].start, 6) if start > 0 else None,
+                        'end':   round(sp.part[end].start, 6) if end < len(sp.part) else None}
+                if plan and plan[-1]['name'] == item['name'] and plan[-1]['end'] == item['start']:
+                    plan[-1]['end'] = item['end']
+                else:
+                    plan.append(item)
+        return plan
+
     def __repr__(self):
         return (f"ConnectPart(subparts={self.subparts.__repr__()}, "
                 f"segments=[{len(self.segments)} elements])")
 
 
 def check_subpart(sp_list):
-    from collections import Counter
-    err_array = bytearray(len(sp_list))
-    seg_num = len(sp_list[0])
-    for seg_i in range(seg_num):
-        for t in ['video', 'audio']:
-            tally = Counter([part_i[seg_i].segment_md5._as_dict[t] for part_i in sp_list]).most_common()
-            if len(tally) > 1:
-                if seg_i == seg_num - 1:
-                    pass  # todo: mark as error
-                else:
-                    raise HashCheckDifference(
-                        f"{t} check error at {sp_list[0][seg_i].start_str}"
-                    )
-    # max(enumerate(sp_list), key=lambda x:x[1])
-    # return sp_list[0]
+    """
+    Raise HashCheckDifference if the digests of the aligned SubParts are different (except the last segment)
+    """
+    for t in ['video', 'audio']:
+        digests = np.stack([sp.column('segment_md5.' + t) for sp in sp_list])
+        different = np.flatnonzero((digests != digests[0]).any(axis=0)[:-1])
+        if len(different) > 0:
+            raise HashCheckDifference(f"{t} check error at {sp_list[0][different[0]].start_str}")
 
 
 # def check_single(hash_seqs, key):
@@ -302,16 +518,37 @@ def check_subpart(sp_list):
 #     return segment_range
 
 
-with open('s1.json') as f:
-    s1 = json.load(f)
-with open('nfg.json') as f:
-    s2 = json.load(f)
-with open('s0.json') as f:
-    s3 = json.load(f)
-
-connect1 = ConnectPart([Part(p) for p in s1])
-connect2 = ConnectPart([Part(p) for p in s2])
-connect3 = ConnectPart([Part(p) for p in s3])
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s [%(levelname).1s] %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="connect hashed parts of a recording and make a splice plan, "
+                                                 "which skips the segments recorded more than once")
+    parser.add_argument('src', help="json or binary file made by segment_hash.py")
+    parser.add_argument('out', help="output path for the splice plan (json file, used by 'encode.py --splice_plan')")
+    parser.add_argument('--at', type=float, nargs='+', default=[], metavar='SEC',
+                        help="show the part and segment playing at these times of the splice plan")
+    parser.add_argument('--align', choices=['index', 'matcher'], default='index',
+                        help="method to find the overlaps of parts, 'matcher' is the old difflib one (default is "
+                             "index)")
+    cli_args = parser.parse_args()
+
+    all_parts = [Part(p) for p in load_hash_file(cli_args.src)]
+    if any(p.quick for p in all_parts):
+        parser.error(f"'{cli_args.src}' is made by 'segment_hash.py --quick', which cannot choose between the "
+                     "overlapping segments of parts, hash the files without --quick to make a splice plan")
+    connect = ConnectPart(all_parts, align=cli_args.align)
+    if len(connect.subparts) > 1:
+        logging.warning(f"parts are not continuous, {len(connect.subparts) - 1} gap(s) in the plan")
+    splice_plan = connect.splice_plan()
+    for item in splice_plan:
+        logging.info(f"{item['name']}: {item['start'] or 0:.3f}s - "
+                     f"{'end' if item['end'] is None else format(item['end'], '.3f') + 's'}")
+    with open(cli_args.out, 'w') as f:
+        json.dump({'parts': splice_plan}, f, indent=1)
+    for t in cli_args.at:
+        if (found := connect.segment_at(t)) is None:
+            logging.info(f"{t:.3f}s: out of range (duration {connect.duration:.3f}s)")
+        else:
+            logging.info(f"{t:.3f}s: {found[0].name} segment {found[1]}, at {found[2]:.3f}s of the file")
 
 # for part1 in s1:
 #     matcher.set_seq1([seg['keyframe_md5'] for seg in part1['data']])
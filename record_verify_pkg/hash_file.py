@@ -0,0 +1,100 @@
+"""
+Compact binary format of segment hash results (the json list written by segment_hash.py).
+
+layout: MAGIC, version (u32), header length (u32), json header, padding to 8 bytes, columns
+The json header has 'count' (number of segments of all parts) and 'parts' (name, time_base, offset and count of
+each part). The columns store the segments of all parts one after another, in the order of COLUMNS: digests are
+raw 16-byte md5, pts and frames are little endian int64. The columns are read from a memory map without copying.
+"""
+import json
+import argparse
+import numpy as np
+
+MAGIC = b'SEGHASH\x00'
+VERSION = 1
+# digests are 'V16' (raw bytes), NumPy strips the trailing NUL bytes of 'S16' values
+COLUMNS = [('keyframe_md5', 'V16'), ('segment_md5.video', 'V16'), ('segment_md5.audio', 'V16'),
+           ('start_pts', '<i8'), ('end_pts', '<i8'), ('frames.video', '<i8'), ('frames.audio', '<i8')]
+
+
+def segment_field(seg, column):
+    value = seg
+    for key in column.split('.'):
+        value = value[key]
+    return value
+
+
+def is_hash_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_hash_file(path, all_info):
+    """
+    :param all_info: list of results of `segment_hash.get_hash`
+    """
+    header = {'count': sum(len(info['data']) for info in all_info), 'parts': []}
+    offset = 0
+    for info in all_info:
+        header['parts'].append({'name': info['name'], 'time_base': info['time_base'], 'offset': offset,
+                                'count': len(info['data'])})
+        offset += len(info['data'])
+    header = json.dumps(header).encode('utf8')
+    with open(path, 'wb') as f:
+        f.write(MAGIC + VERSION.to_bytes(4, 'little') + len(header).to_bytes(4, 'little') + header)
+        f.write(b'\x00' * (-f.tell() % 8))
+        for column, dtype in COLUMNS:
+            if dtype == 'V16':
+                values = [bytes.fromhex(segment_field(seg, column)) for info in all_info for seg in info['data']]
+            else:
+                values = [segment_field(seg, column) for info in all_info for seg in info['data']]
+            f.write(np.array(values, dtype=dtype).tobytes())
+
+
+def read_hash_file(path):
+    """
+    :return: list of parts as dict of 'name', 'time_base' and 'columns' (dict of column name -> read-only array)
+    """
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    if bytes(buffer[:len(MAGIC)]) != MAGIC:
+        raise ValueError(f"'{path}' is not a segment hash file")
+    pos = len(MAGIC)
+    version = int.from_bytes(bytes(buffer[pos:pos + 4]), 'little')
+    if version != VERSION:
+        raise ValueError(f"unsupported version {version} of '{path}'")
+    header_len = int.from_bytes(bytes(buffer[pos + 4:pos + 8]), 'little')
+    header = json.loads(bytes(buffer[pos + 8:pos + 8 + header_len]))
+    pos += 8 + header_len
+    pos += -pos % 8
+    count = header['count']
+    columns = {}
+    for column, dtype in COLUMNS:
+        size = count * np.dtype(dtype).itemsize
+        columns[column] = buffer[pos:pos + size].view(dtype)
+        pos += size
+    if pos > len(buffer):
+        raise ValueError(f"'{path}' is truncated")
+    return [{'name':      p['name'],
+             'time_base': p['time_base'],
+             'columns':   {k: v[p['offset']:p['offset'] + p['count']] for k, v in columns.items()}}
+            for p in header['parts']]
+
+
+def load_hash_file(path):
+    """
+    :return: the list of results in the file, json or binary
+    """
+    if is_hash_file(path):
+        return read_hash_file(path)
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="convert json files made by segment_hash.py to the binary format")
+    parser.add_argument('src', help="json file made by segment_hash.py")
+    parser.add_argument('out', help="output path for the binary file")
+    cli_args = parser.parse_args()
+
+    with open(cli_args.src) as f:
+        write_hash_file(cli_args.out, json.load(f))
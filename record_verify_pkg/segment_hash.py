@@ -7,6 +7,12 @@ from io import BytesIO
 import av
 import time
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from itertools import chain
+from functools import partial
+from queue import Empty
+from hash_file import write_hash_file
 
 
 def check_av_stream(container):
@@ -28,7 +34,316 @@ def print_refresh(*args, **kwargs):
         print_refresh.time = time.time()
 
 
-def get_hash(video_name):
+class FLVTail:
+    """
+    Read-only file object of an FLV file starting from the tag at `start`, with the head of the file (FLV header,
+    metadata and sequence headers before the first keyframe at `head_end`) prepended, so it is demuxed as a
+    complete FLV
+    """
+
+    def __init__(self, name, head_end, start):
+        self._file = open(name, 'rb')
+        self._head = self._file.read(head_end)
+        if self._head[:3] != b'FLV':
+            raise ValueError(f"'{name}' is not an FLV file")
+        self.head_end = head_end
+        self.offset = start - head_end  # position in the file = position in this object + offset (after the head)
+        self._file.seek(start)
+
+    def file_pos(self, pos):
+        return pos if pos < self.head_end else pos + self.offset
+
+    def read(self, size=-1):
+        if self._head:
+            data, self._head = self._head[:size], self._head[size:]
+            return data
+        return self._file.read(size)
+
+    def close(self):
+        self._file.close()
+
+
+class SegmentHasher:
+    """
+    Digests of the segments (starting from video keyframes), fed packet by packet in the order of the file
+    """
+
+    def __init__(self, max_pts=-1000000):
+        """
+        :param max_pts: 'end_pts' of the previous segment when resuming
+        """
+        self.keyframe_info = []
+        self.max_pts = max_pts
+        self._md5 = None  # hash objects of the current segment
+        self._frames = None
+
+    def _close_segment(self):
+        if self._md5 is not None:
+            self.keyframe_info[-1]['max_pts'] = self.max_pts
+            self.keyframe_info[-1]['frames'] = self._frames
+            self.keyframe_info[-1]['segment_md5'] = {s: self._md5[s].hexdigest() for s in ['audio', 'video']}
+            self._md5 = self._frames = None
+
+    def add(self, stream_type, pts, data, is_keyframe=False):
+        """
+        :param stream_type: 'audio' or 'video'
+        :param data: packet data (any object supporting the buffer protocol, e.g. av.Packet)
+        """
+        if stream_type == 'video':
+            if is_keyframe:
+                self._close_segment()
+                self.keyframe_info.append({'pts': pts, 'md5': md5(data).hexdigest()})
+            self.max_pts = max(self.max_pts, pts)
+        if self._md5 is None:
+            self._md5 = {'audio': md5(), 'video': md5()}
+            self._frames = {'audio': 0, 'video': 0}
+        self._md5[stream_type].update(data)
+        self._frames[stream_type] += 1
+
+    def segments(self):
+        """
+        Close the last segment
+        :return: list of segment info, the 'data' of `get_hash`
+        """
+        self._close_segment()
+        return [{'start_pts':    k['pts'],
+                 'end_pts':      k['max_pts'],
+                 'frames':       k['frames'],
+                 'keyframe_md5': k['md5'],
+                 'segment_md5':  k['segment_md5']} for k in self.keyframe_info]
+
+
+def get_hash(video_name, progress=None, resume=None, positions=None):
+    """
+    Hash the packets of each segment (starting from a video keyframe) directly. The digests are the same as the
+    ones given by `get_hash_muxer` (md5 muxer hashes the packet data only), but no muxer is opened per segment.
+
+    :param video_name: path of the video
+    :param progress: called with the byte position at each keyframe instead of printing the progress
+    :param resume: (byte position of the first segment, byte position of a keyframe tag, 'end_pts' of the previous
+                   segment) to hash an FLV file from the keyframe, the segments are the same as the ones when
+                   hashing from the beginning
+    :param positions: list to append the byte position of each segment (keyframe tag)
+    :return: dict of 'name', 'time_base' and 'data' (list of segment info)
+    """
+    hasher = SegmentHasher() if resume is None else SegmentHasher(resume[2])
+    source = video_name
+    file_pos = int
+    if resume is not None:
+        source = FLVTail(video_name, resume[0], resume[1])
+        file_pos = source.file_pos
+
+    with av.open(source, metadata_errors='ignore') as input_:
+        check_av_stream(input_)
+        time_base = {s: float(getattr(input_.streams, s)[0].time_base) for s in ['audio', 'video']}
+        for i, packet in enumerate(input_.demux()):
+            if packet.dts is None:
+                continue
+            s = packet.stream.type
+            if s == 'video' and packet.is_keyframe:
+                if progress is None:
+                    print_refresh(f"packet {i}, time {float(packet.pts * packet.time_base):.3f}s")
+                else:
+                    progress(file_pos(packet.pos))
+                if positions is not None:
+                    positions.append(file_pos(packet.pos))
+            hasher.add(s, packet.pts, packet, packet.is_keyframe)
+    if resume is not None:
+        source.close()
+    if progress is None:
+        print(' ' * 79 + '\r' + f"{os.path.basename(video_name)} finished")
+
+    return {'name': os.path.basename(video_name), 'time_base': time_base, 'data': hasher.segments()}
+
+
+def flv_keyframes(file, progress=None):
+    """
+    Read the keyframes of an FLV file by its tag headers, the payloads of other tags are skipped by seeking.
+    The packet data and pts are the same as the ones demuxed by FFmpeg.
+
+    :param file: binary file object at the beginning of the FLV
+    :return: generator of (byte position of the tag, pts, packet data), stops at the end or at a truncated tag
+    """
+    header = file.read(9)
+    if len(header) < 9 or header[:3] != b'FLV':
+        raise ValueError("not an FLV file")
+    file.seek(int.from_bytes(header[5:9], 'big') + 4)  # + PreviousTagSize0
+    while len(tag := file.read(12)) == 12:  # tag header and the first byte of the payload
+        pos = file.tell() - 12
+        size = int.from_bytes(tag[1:4], 'big')
+        timestamp = int.from_bytes(tag[7:8] + tag[4:7], 'big')
+        flags = tag[11]
+        if tag[0] & 0x1f != 9 or flags >> 4 != 1 or size < 1:  # not a video keyframe
+            file.seek(pos + 11 + size + 4)
+            continue
+        if flags & 0x80:
+            raise ValueError("enhanced FLV is not supported")
+        data = file.read(size - 1)
+        if len(data) < size - 1:
+            break
+        file.seek(4, 1)  # PreviousTagSize
+        if progress is not None:
+            progress(pos)
+        if flags & 0xf in [7, 12]:  # AVC, HEVC
+            if len(data) < 4 or data[0] != 1:  # sequence header or end of sequence
+                continue
+            yield pos, timestamp + int.from_bytes(data[1:4], 'big', signed=True), data[4:]
+        else:
+            yield pos, timestamp, data
+
+
+def flv_packet(tag_type, timestamp, payload):
+    """
+    The packet demuxed by FFmpeg from an FLV tag
+    :return: (stream type, pts, packet data, is keyframe), or None if the tag is not a packet (script data,
+             sequence headers, etc.)
+    """
+    if tag_type == 8 and len(payload) > 1:
+        if payload[0] >> 4 == 10:  # AAC
+            if payload[1] != 1:  # sequence header
+                return None
+            return ('audio', timestamp, payload[2:], True) if len(payload) > 2 else None
+        return 'audio', timestamp, payload[1:], True
+    if tag_type == 9 and len(payload) > 1:
+        flags = payload[0]
+        if flags & 0x80:
+            raise ValueError("enhanced FLV is not supported")
+        if flags >> 4 == 5:  # video info/command frame
+            return None
+        if flags & 0xf in [7, 12]:  # AVC, HEVC
+            if len(payload) <= 5 or payload[1] != 1:  # sequence header or end of sequence
+                return None
+            cts = int.from_bytes(payload[2:5], 'big', signed=True)
+            return 'video', timestamp + cts, payload[5:], flags >> 4 == 1
+        return 'video', timestamp, payload[1:], flags >> 4 == 1
+    return None
+
+
+class FLVStreamHasher:
+    """
+    Hash an FLV stream as the bytes arrive (e.g. while downloading, or from a pipe), without PyAV.
+    The result is the same as `get_hash` of the complete file.
+    """
+
+    def __init__(self, name, progress=None):
+        """
+        :param name: name of the video in the result
+        :param progress: called with the byte position at each keyframe
+        """
+        self.name = name
+        self.progress = progress
+        self.position = 0  # byte position of the data not parsed yet
+        self._buffer = bytearray()
+        self._header = True
+        self._streams = set()
+        self._hasher = SegmentHasher()
+
+    def feed(self, data):
+        self._buffer += data
+        buffer = memoryview(self._buffer)
+        i = 0
+        if self._header:
+            if len(buffer) < 9:
+                return
+            if buffer[:3] != b'FLV':
+                raise ValueError(f"'{self.name}' is not an FLV stream")
+            i = int.from_bytes(buffer[5:9], 'big') + 4  # + PreviousTagSize0
+            if len(buffer) < i:
+                return
+            self._header = False
+        while len(buffer) - i >= 11:
+            size = int.from_bytes(buffer[i + 1:i + 4], 'big')
+            if len(buffer) - i < 11 + size + 4:
+                break
+            self._tag(buffer[i:i + 11 + size], self.position + i)
+            i += 11 + size + 4
+        buffer.release()
+        del self._buffer[:i]
+        self.position += i
+
+    def _tag(self, tag, pos):
+        tag_type = tag[0] & 0x1f
+        if tag_type in [8, 9]:
+            self._streams.add('audio' if tag_type == 8 else 'video')
+        timestamp = int.from_bytes(bytes(tag[7:8]) + bytes(tag[4:7]), 'big')
+        if (packet := flv_packet(tag_type, timestamp, tag[11:])) is not None:
+            if packet[0] == 'video' and packet[3] and self.progress is not None:
+                self.progress(pos)
+            self._hasher.add(*packet)
+
+    def result(self):
+        """
+        :return: result like `get_hash` of the data fed, an incomplete tag at the end is ignored
+        """
+        if self._streams != {'audio', 'video'}:
+            raise ValueError(f'cannot process streams: {sorted(self._streams)}')
+        return {'name': self.name, 'time_base': {'audio': 0.001, 'video': 0.001}, 'data': self._hasher.segments()}
+
+
+def hash_flv_stream(stream, name, tee=None, progress=None, chunk_size=1 << 20):
+    """
+    Hash an FLV from a binary stream (pipe, socket file, response body...) with FLVStreamHasher
+    :param tee: file object to write the data read, so the video is saved and hashed in one pass
+    """
+    hasher = FLVStreamHasher(name, progress)
+    while data := stream.read(chunk_size):
+        if tee is not None:
+            tee.write(data)
+        hasher.feed(data)
+        if progress is None:
+            print_refresh(f"{hasher.position / 1048576:.1f} MiB")
+    if progress is None:
+        print(' ' * 79 + '\r' + f"{name} finished")
+    return hasher.result()
+
+
+def get_keyframe_hash(video_name, progress=None):
+    """
+    Quick fingerprint of a video: only the 'start_pts' and 'keyframe_md5' of each segment, which are enough for
+    aligning parts in check_segment.ConnectPart. The payloads of other packets are skipped: by the tag headers of
+    FLV files, or by seeking to the next keyframe with the index of other containers (e.g. MP4).
+
+    :return: dict of 'name', 'time_base' and 'data' like `get_hash`, with 'quick' set
+    """
+    with av.open(video_name, metadata_errors='ignore') as input_:
+        check_av_stream(input_)
+        time_base = {s: float(getattr(input_.streams, s)[0].time_base) for s in ['audio', 'video']}
+        is_flv = input_.format.name == 'flv'
+        keyframes = []
+        if not is_flv:
+            v = input_.streams.video[0]
+            last_dts = None
+            while True:
+                if last_dts is not None:
+                    try:
+                        input_.seek(last_dts + 1, stream=v, backward=False)
+                    except av.AVError:
+                        break
+                for packet in input_.demux(v):
+                    if packet.dts is None or not packet.is_keyframe or (last_dts is not None
+                                                                        and packet.dts <= last_dts):
+                        continue  # not expected after seeking, but the keyframe is still found by reading
+                    keyframes.append((packet.pos, packet.pts, bytes(packet)))
+                    last_dts = packet.dts
+                    if progress is not None:
+                        progress(packet.pos)
+                    break
+                else:
+                    break
+    if is_flv:
+        with open(video_name, 'rb') as f:
+            keyframes = list(flv_keyframes(f, progress))
+    if progress is None:
+        print(' ' * 79 + '\r' + f"{os.path.basename(video_name)} finished")
+
+    out = [{'start_pts': pts, 'keyframe_md5': md5(data).hexdigest()} for pos, pts, data in keyframes]
+    return {'name': os.path.basename(video_name), 'time_base': time_base, 'quick': True, 'data': out}
+
+
+def get_hash_muxer(video_name, progress=None):
+    """
+    The original implementation of `get_hash` using md5 muxers, kept for checking the results
+    """
     def close_last_segment():
         nonlocal segment_md5_containers, max_pts
         if segment_md5_containers is not None:
@@ -58,7 +373,10 @@ def get_hash(video_name):
 
             if packet.stream.type == 'video':
                 if packet.is_keyframe:
-                    print_refresh(f"packet {i}, time {float(packet.pts * packet.time_base):.3f}s")
+                    if progress is None:
+                        print_refresh(f"packet {i}, time {float(packet.pts * packet.time_base):.3f}s")
+                    else:
+                        progress(packet.pos)
                     close_last_segment()
                     keyframe_info.append({'pts': packet.pts, 'md5': md5(packet).hexdigest()})
                 max_pts = max(max_pts, packet.pts)
@@ -74,7 +392,8 @@ def get_hash(video_name):
             packet.stream = segment_md5_containers[packet.stream.type].streams[0]
             segment_md5_containers[packet.stream.type].mux(packet)
         close_last_segment()
-    print(' ' * 79 + '\r' + f"{os.path.basename(video_name)} finished")
+    if progress is None:
+        print(' ' * 79 + '\r' + f"{os.path.basename(video_name)} finished")
 
     # post-processing
     # convert BytesIO to md5 values list and reformat to list of dicts
@@ -96,27 +415,200 @@ def get_hash(video_name):
     return {'name': os.path.basename(video_name), 'time_base': time_base, 'data': out}
 
 
-parser = argparse.ArgumentParser(description="hash video or video sequences segmented by key frame")
-parser.add_argument('src', help="source file/directory for input video(s)")
-parser.add_argument('out', help="output path for json file")
-cli_args = parser.parse_args()
+class HashCache:
+    """
+    Results of `get_hash` stored in a directory (one json file per video), keyed by the identity of the video file:
+    path, size, mtime, inode and the md5 of its head. A video which only grew (e.g. downloaded or recorded after
+    the last run) is hashed again from the keyframe of its last segment.
+    """
+    version = 1
+    head_size = 65536
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, video_name):
+        return os.path.join(self.directory, md5(os.path.abspath(video_name).encode('utf8')).hexdigest() + '.json')
+
+    def identity(self, video_name):
+        st = os.stat(video_name)
+        with open(video_name, 'rb') as f:
+            head_md5 = md5(f.read(self.head_size)).hexdigest()
+        return {'path': os.path.abspath(video_name), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                'inode': st.st_ino, 'head_md5': head_md5}
+
+    def get(self, video_name):
+        try:
+            with open(self._path(video_name), encoding='utf8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get('version') == self.version else None
+
+    def put(self, identity, result, positions):
+        path = self._path(identity['path'])
+        with open(path + '.tmp', 'w', encoding='utf8') as f:
+            json.dump({'version': self.version, 'identity': identity, 'positions': positions, 'result': result}, f)
+        os.replace(path + '.tmp', path)
+
+
+def get_hash_cached(video_name, progress=None, cache=None):
+    """
+    `get_hash` with the results stored in `cache` (directory of HashCache)
+    """
+    if cache is None:
+        return get_hash(video_name, progress)
+    cache = HashCache(cache)
+    identity = cache.identity(video_name)
+    entry = cache.get(video_name)
+    if entry is not None and entry['identity'] == identity:
+        if progress is None:
+            print(f"{os.path.basename(video_name)} unchanged, cached")
+        return entry['result']
+    positions = []
+    old = None if entry is None else entry['identity']
+    if (old is not None and video_name[-3:] == 'flv' and len(entry['positions']) > 1
+            and all(old[k] == identity[k] for k in ['path', 'inode', 'head_md5'])
+            and old['size'] < identity['size'] and old['mtime_ns'] <= identity['mtime_ns']):
+        # the last segment may be incomplete when cached, hash again from its keyframe
+        data = entry['result']['data'][:-1]
+        result = get_hash(video_name, progress, (entry['positions'][0], entry['positions'][-1], data[-1]['end_pts']), positions)
+        result['data'] = data + result['data']
+        positions = entry['positions'][:-1] + positions
+    else:
+        result = get_hash(video_name, progress, positions=positions)
+    cache.put(identity, result, positions)
+    return result
+
+
+def list_videos(src_path):
+    """
+    :return: sorted videos in the directory (as a sequence of videos), or the video itself
+    """
+    if os.path.isdir(src_path):
+        return [os.path.join(src_path, n) for n in sorted(os.listdir(src_path)) if n[-3:] in ['flv', 'mp4']]
+    return [src_path]
+
+
+def output_name(src_path, ext='.json'):
+    """
+    :return: name of the output file for one of several sources, e.g. 'REC/source' -> 'REC.json'
+    """
+    path = os.path.abspath(src_path)
+    name = os.path.basename(path)
+    if name == 'source':  # the layout of recording directories
+        name = os.path.basename(os.path.dirname(path))
+    return os.path.splitext(name)[0] + ext
+
+
+def _hash_worker(hash_func, video_name, queue):
+    last_time = 0
+
+    def progress(pos):
+        nonlocal last_time
+        if last_time + 0.5 < time.time():
+            queue.put((video_name, pos))
+            last_time = time.time()
+
+    return hash_func(video_name, progress)
+
+
+def hash_files(video_names, jobs=1, hash_func=get_hash):
+    """
+    Hash videos in a process pool of `jobs` workers, and print the progress of all workers by bytes
+    :return: results of `hash_func`, in the order of `video_names`
+    """
+    if jobs <= 1:
+        return [hash_func(n) for n in video_names]
+    sizes = {n: os.path.getsize(n) for n in video_names}
+    total_size = max(1, sum(sizes.values()))
+    position = dict.fromkeys(video_names, 0)
+    with multiprocessing.Manager() as manager, ProcessPoolExecutor(jobs) as pool:
+        queue = manager.Queue()
+        futures = {pool.submit(_hash_worker, hash_func, n, queue): n for n in video_names}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.5)
+            while True:
+                try:
+                    name, pos = queue.get_nowait()
+                except Empty:
+                    break
+                if pos is not None and pos > 0:
+                    position[name] = max(position[name], pos)
+            for f in done:
+                position[futures[f]] = sizes[futures[f]]
+                if f.exception() is None:
+                    print(' ' * 79 + '\r' + f"{os.path.basename(futures[f])} finished")
+            print_refresh(f"{len(futures) - len(pending)}/{len(futures)} files, "
+                          f"{sum(position.values()) / total_size * 100:.1f}%")
+        return [f.result() for f in futures]
 
-src_path = cli_args.src
-out_path = cli_args.out
 
-all_info = []
-# pre-check file write access
-open(out_path, 'a').close()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="hash video or video sequences segmented by key frame")
+    parser.add_argument('src', nargs='+',
+                        help="source file/directory for input video(s), several of them can be given (e.g. the "
+                             "'source' directories of recordings), '-' reads an FLV stream from stdin")
+    parser.add_argument('out', help="output path for json file, or the output directory for several sources "
+                                    "(one json file per source, named after the recording)")
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help="hash N files at the same time in worker processes (default is 1)")
+    parser.add_argument('--muxer', action='store_true',
+                        help="hash by md5 muxers like the old versions (much slower, for checking the results)")
+    parser.add_argument('-q', '--quick', action='store_true',
+                        help="only hash keyframes (enough for aligning parts), skipping other packets")
+    parser.add_argument('-f', '--format', choices=['json', 'bin'], default='json',
+                        help="'bin' writes the compact binary format of hash_file.py (default is json)")
+    parser.add_argument('--cache', metavar='DIR',
+                        help="reuse the results of unchanged files stored in DIR, and only hash the new data of "
+                             "grown FLV files")
+    parser.add_argument('--tee', metavar='PATH',
+                        help="save the FLV stream from stdin to PATH while hashing it, "
+                             "e.g. 'curl URL | segment_hash.py - out.json --tee video.flv'")
+    cli_args = parser.parse_args()
+    from_stdin = '-' in cli_args.src
+    if from_stdin and (len(cli_args.src) > 1 or cli_args.muxer or cli_args.quick or cli_args.cache is not None):
+        parser.error("stdin cannot be used with other sources, --muxer, --quick or --cache")
+    if cli_args.tee is not None and not from_stdin:
+        parser.error("--tee can only be used with stdin ('-')")
+    hash_func = get_hash_muxer if cli_args.muxer else get_hash
+    if cli_args.cache is not None:
+        if cli_args.muxer:
+            parser.error("--cache cannot be used with --muxer")
+        hash_func = partial(get_hash_cached, cache=cli_args.cache)
+    if cli_args.quick:
+        if cli_args.muxer or cli_args.cache is not None or cli_args.format != 'json':
+            parser.error("--quick cannot be used with --muxer, --cache or the binary format")
+        hash_func = get_keyframe_hash
 
-# dir as a sequence of videos
-if os.path.isdir(src_path):
-    vid_names = os.listdir(src_path)
-    vid_names.sort()
-    for vid_name in vid_names:
-        if vid_name[-3:] in ['flv', 'mp4']:
-            all_info.append(get_hash(os.path.join(src_path, vid_name)))
-else:  # single video also OK
-    all_info.append(get_hash(src_path))
+    if len(cli_args.src) == 1:
+        out_paths = [cli_args.out]
+    else:
+        os.makedirs(cli_args.out, exist_ok=True)
+        out_paths = [os.path.join(cli_args.out, output_name(src, '.' + cli_args.format)) for src in cli_args.src]
+        if len(set(out_paths)) < len(out_paths):
+            parser.error("sources with the same name are given")
+    # pre-check file write access
+    for out_path in out_paths:
+        open(out_path, 'a').close()
 
-with open(out_path, 'w') as f:
-    json.dump(all_info, f, indent=1)
+    if from_stdin:
+        stream_name = 'stdin.flv' if cli_args.tee is None else os.path.basename(cli_args.tee)
+        all_names = [[stream_name]]
+        tee_f = None if cli_args.tee is None else open(cli_args.tee, 'wb')
+        try:
+            all_info = iter([hash_flv_stream(sys.stdin.buffer, stream_name, tee_f)])
+        finally:
+            if tee_f is not None:
+                tee_f.close()
+    else:
+        all_names = [list_videos(src) for src in cli_args.src]
+        all_info = iter(hash_files(list(chain.from_iterable(all_names)), cli_args.jobs, hash_func))
+    for names, out_path in zip(all_names, out_paths):
+        if cli_args.format == 'bin':
+            write_hash_file(out_path, [next(all_info) for _ in names])
+            continue
+        with open(out_path, 'w') as f:
+            json.dump([next(all_info) for _ in names], f, indent=1)
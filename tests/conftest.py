@@ -0,0 +1,54 @@
+import os
+import sys
+from fractions import Fraction
+from hashlib import md5
+
+import av
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the scripts import their neighbours as top-level modules
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'record_verify_pkg')]
+
+
+def make_flv(path, seconds, start=0):
+    """
+    Write a small FLV like a recording: 320x240 30fps H.264 with a keyframe every second, and AAC audio
+    """
+    c = av.open(path, 'w', format='flv')
+    v = c.add_stream('libx264', rate=30, options={'g': '30'})
+    v.width, v.height, v.pix_fmt = 320, 240, 'yuv420p'
+    a = c.add_stream('aac', rate=44100)
+    for i in range(start * 30, (start + seconds) * 30):
+        frame = av.VideoFrame.from_ndarray(np.full((240, 320, 3), i * 7 % 255, np.uint8), format='rgb24')
+        frame.pts, frame.time_base = i, Fraction(1, 30)
+        c.mux(v.encode(frame))
+    c.mux(v.encode(None))
+    pts = start * 44100
+    for _ in range(seconds * 44100 // 1024):
+        frame = av.AudioFrame.from_ndarray((np.sin(np.arange(1024) / 10) * 0.3).astype(np.float32).reshape(1, -1),
+                                           format='fltp', layout='mono')
+        frame.sample_rate, frame.pts, frame.time_base = 44100, pts, Fraction(1, 44100)
+        pts += 1024
+        c.mux(a.encode(frame))
+    c.mux(a.encode(None))
+    c.close()
+
+
+def digest(text):
+    return md5(text.encode()).hexdigest()
+
+
+def make_info(name, keyframe_md5s, quick=False):
+    """
+    Hash result of a video like `segment_hash.get_hash` (`get_keyframe_hash` if quick) with 1s segments, segments
+    with the same keyframe digest have the same content
+    """
+    data = []
+    for i, k in enumerate(keyframe_md5s):
+        seg = {'start_pts': i * 1000, 'keyframe_md5': k}
+        if not quick:
+            seg.update({'end_pts': i * 1000 + 967, 'frames': {'video': 30, 'audio': 47},
+                        'segment_md5': {t: digest(t + k) for t in ['video', 'audio']}})
+        data.append(seg)
+    return {'name': name, 'time_base': {'audio': 0.001, 'video': 0.001}, 'data': data}
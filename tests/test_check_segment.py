@@ -0,0 +1,95 @@
+import pytest
+
+from check_segment import ConnectPart, Part, Segment
+from conftest import digest, make_info
+
+
+def make_part(name, keys, quick=False):
+    """
+    :param keys: keyframe names of the segments
+    """
+    return Part(make_info(name, [digest(k) for k in keys], quick))
+
+
+def overlapping_parts(quick=False):
+    return [make_part('a.flv', ['k0', 'k1', 'k2', 'k3'], quick), make_part('b.flv', ['k2', 'k3', 'k4', 'k5'], quick)]
+
+
+def test_splice_plan():
+    plan = ConnectPart(overlapping_parts()).splice_plan()
+    assert [item['name'] for item in plan] == ['a.flv', 'b.flv']
+    assert plan[0]['start'] is None and plan[-1]['end'] is None
+
+
+def test_splice_plan_refuses_quick():
+    connect = ConnectPart(overlapping_parts(quick=True))
+    with pytest.raises(ValueError, match='--quick'):
+        connect.splice_plan()
+
+
+def test_segments():
+    parts = overlapping_parts() + [make_part('c.flv', ['x0', 'x1'])]  # c.flv is not connected
+    segments = ConnectPart(parts).segments
+    expected = list(parts[0]) + list(parts[1][2:]) + [Segment()] + list(parts[2]) + [Segment()]
+    assert len(segments) == len(expected)
+    assert [tuple(s) for s in segments] == [tuple(s) for s in expected]
+    assert [tuple(segments[i]) for i in range(-len(expected), 0)] == [tuple(s) for s in expected]
+
+
+@pytest.mark.parametrize('keys', [
+    [['k0', 'k1', 'k2', 'k3'], ['k2', 'k3', 'k4', 'k5']],  # overlapping
+    [['k0', 'k1'], ['x0', 'x1'], ['x1', 'x2']],  # not connected, then overlapping
+    [['k0', 'k1', 'k2', 'k3'], ['k1', 'k2']],  # contained
+    [['k0', 'k1', 'k0', 'k1', 'k2'], ['k0', 'k1', 'k2', 'k3']],  # repeated keyframes, the overlap is the longest
+    [['k0', 'k1'], ['k0', 'k1']],  # the same part twice
+])
+def test_align_index_same_as_matcher(keys):
+    parts = [make_part(f'{i}.flv', k) for i, k in enumerate(keys)]
+    by_index = ConnectPart(parts, align='index')
+    by_matcher = ConnectPart(parts, align='matcher')
+    assert by_index._all_segments == by_matcher._all_segments
+    assert by_index.splice_plan() == by_matcher.splice_plan()
+
+
+@pytest.fixture
+def connected():
+    """
+    a.flv 0-3.967s, then b.flv from its segment 2 (3.967-5.934s), then c.flv after a gap (5.934-7.901s)
+    """
+    return ConnectPart(overlapping_parts() + [make_part('c.flv', ['x0', 'x1'])])
+
+
+def located(found):
+    part, seg_i, t = found
+    return part.name, seg_i, pytest.approx(t)
+
+
+def test_segment_at(connected):
+    assert connected.duration == pytest.approx(7.901)
+    assert located(connected.segment_at(0)) == ('a.flv', 0, 0)
+    # the last segment of a file lasts until its end_pts, the splice starts at the next keyframe of b.flv
+    assert located(connected.segment_at(3.966)) == ('a.flv', 3, 3.966)
+    assert located(connected.segment_at(3.967)) == ('b.flv', 2, 2)
+    assert located(connected.segment_at(4.5)) == ('b.flv', 2, 2.533)
+    # the gap has no length, the next part plays from its beginning
+    assert located(connected.segment_at(5.933)) == ('b.flv', 3, 3.966)
+    assert located(connected.segment_at(5.934)) == ('c.flv', 0, 0)
+    assert connected.segment_at(7.901) is None
+    assert connected.segment_at(-1) is None
+
+
+def test_segments_between(connected):
+    found = [(p.name, i, s, e) for p, i, s, e in connected.segments_between(3.5, 6)]
+    assert found == [('a.flv', 3, 3, pytest.approx(3.967)), ('b.flv', 2, pytest.approx(3.967), pytest.approx(4.967)),
+                     ('b.flv', 3, pytest.approx(4.967), pytest.approx(5.934)),
+                     ('c.flv', 0, pytest.approx(5.934), pytest.approx(6.934))]
+    # the end is excluded, a range ending at the splice does not reach b.flv
+    assert [(p.name, i) for p, i, s, e in connected.segments_between(3, 3.967)] == [('a.flv', 3)]
+    assert [(p.name, i) for p, i, s, e in connected.segments_between(5.934, 5.935)] == [('c.flv', 0)]
+    assert connected.segments_between(8, 9) == []
+
+
+def test_gaps(connected):
+    assert connected.gaps() == [pytest.approx(5.934)]
+    assert connected.gaps(0, 5) == []
+    assert connected.gaps(5, 6) == [pytest.approx(5.934)]
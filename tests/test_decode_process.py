@@ -0,0 +1,46 @@
+import threading
+
+import av
+import pytest
+
+from conftest import make_flv
+import encode
+
+pytestmark = pytest.mark.skipif('libx264' not in av.codecs_available or
+                                not hasattr(av.video.stream.VideoStream, 'framerate'),
+                                reason="needs libx264 and PyAV with VideoStream.framerate")
+
+
+def transcode_hq(src, dst, decode_process):
+    """
+    :return: number of video frames in the hq output
+    """
+    _, out_list, out_info = encode.open_outputs(dst, 'H')
+    # a frame budget of one frame gives the decode process fewer ring slots than the delay of 8 frame threads
+    transcoder = encode.Transcoder(out_list, out_info, frame_budget=200000, decode_process=decode_process,
+                                   threads={'cores': 8, 'decode': 8, 'hq': 1}, decode_thread_type='FRAME')
+    errors = []
+
+    def run():
+        try:
+            transcoder.append(src)
+            transcoder.flush_close()
+        except BaseException as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive(), "transcoding did not finish"
+    if errors:
+        raise errors[0]
+    with av.open(out_list[0].name) as c:
+        return sum(1 for p in c.demux(video=0) if p.dts is not None)
+
+
+def test_flush_frame_threads(tmp_path):
+    src = str(tmp_path / 'a.flv')
+    make_flv(src, 2)
+    (tmp_path / 'process').mkdir()
+    (tmp_path / 'thread').mkdir()
+    assert transcode_hq(src, str(tmp_path / 'process'), True) == transcode_hq(src, str(tmp_path / 'thread'), False)
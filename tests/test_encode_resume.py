@@ -0,0 +1,69 @@
+import os
+import subprocess
+import sys
+
+import av
+import pytest
+
+from conftest import ROOT, make_flv
+
+pytestmark = pytest.mark.skipif(not {'libsvtav1', 'libopus', 'libx264'} <= av.codecs_available or
+                                not hasattr(av.video.stream.VideoStream, 'framerate'),
+                                reason="needs libsvtav1, libopus, libx264 and PyAV with VideoStream.framerate")
+
+
+def ends(path):
+    """
+    :return: end time of each media type, and the number of decoded audio samples
+    """
+    end = {}
+    samples = 0
+    with av.open(path) as c:
+        for frame in c.decode(*c.streams):
+            t = 'audio' if isinstance(frame, av.AudioFrame) else 'video'
+            if t == 'audio':
+                samples += frame.samples
+                end[t] = float(frame.pts * frame.time_base) + frame.samples / frame.sample_rate
+            else:
+                end[t] = float(frame.pts * frame.time_base)
+    return end, samples
+
+
+def video_frames(path):
+    with av.open(path) as c:
+        return sum(1 for _ in c.decode(video=0))
+
+
+@pytest.fixture(scope='module')
+def outputs(tmp_path_factory):
+    """
+    :return: output directories of a single run and a resumed run (one part per input) of the same two inputs
+    """
+    tmp_path = tmp_path_factory.mktemp('resume')
+    src = tmp_path / 'src'
+    src.mkdir()
+    make_flv(str(src / 'a.flv'), 6)
+    make_flv(str(src / 'b.flv'), 6, 6)
+    dirs = []
+    for name, args in [('single', []), ('resume', ['--resume'])]:
+        dst = tmp_path / name
+        dst.mkdir()
+        subprocess.run([sys.executable, os.path.join(ROOT, 'encode.py'), str(src), str(dst), '-t', 'HC', *args],
+                       check=True, capture_output=True)
+        dirs.append(dst)
+    return dirs
+
+
+def test_resume_compact_continuous(outputs):
+    (single_end, single_samples), (resume_end, resume_samples) = [ends(str(d / 'compact.webm')) for d in outputs]
+    # each resumed part must not add the priming of its new encoder to the timeline, the priming dropped from the
+    # 44.1kHz input may be resampled to one sample more or less
+    assert abs(resume_samples - single_samples) <= 1
+    assert resume_end['audio'] == pytest.approx(single_end['audio'], abs=0.002)
+    assert resume_end['video'] == pytest.approx(single_end['video'], abs=0.002)
+
+
+def test_resume_hq_frames(outputs):
+    # the joined parts keep the last frame
+    single, resume = [video_frames(str(d / 'hq.mp4')) for d in outputs]
+    assert resume == single == 360
@@ -0,0 +1,25 @@
+from hashlib import md5
+from hash_file import read_hash_file, write_hash_file
+from check_segment import Part
+from conftest import digest, make_info
+
+
+def digest_ending_with_nul():
+    i = 0
+    while not (d := md5(str(i).encode()).digest()).endswith(b'\x00'):
+        i += 1
+    return d.hex()
+
+
+def test_round_trip(tmp_path):
+    nul = digest_ending_with_nul()
+    all_info = [make_info('a.flv', [digest('a'), nul]), make_info('b.flv', [nul, digest('b')]),
+                make_info('c.flv', [])]
+    path = tmp_path / 'hash.bin'
+    write_hash_file(path, all_info)
+    parts = read_hash_file(path)
+    assert [p['name'] for p in parts] == ['a.flv', 'b.flv', 'c.flv']
+    assert parts[0]['columns']['keyframe_md5'][1].tobytes() == bytes.fromhex(nul)
+    for info, part in zip(all_info, parts):
+        assert [tuple(s) for s in Part(part)] == [tuple(s) for s in Part(info)]
+        assert [s.keyframe_md5 for s in Part(part)] == [seg['keyframe_md5'] for seg in info['data']]